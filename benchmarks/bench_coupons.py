@@ -0,0 +1,89 @@
+"""Micro-benchmark for collecting coupons while paging through a price page.
+
+Compares the old pagination loop, which parsed every row after each "view
+more" click and checked each coupon against a list, with CouponCollector plus
+only parsing the rows added since the last click.
+
+    python benchmarks/bench_coupons.py [saved_page.html] [--per-click 10] [--repeat 5]
+
+Without a saved page a generated 300 pharmacy page is used.
+"""
+import sys
+import timeit
+import argparse
+
+from samplepage import loadPage, pageStates
+import goodrx
+
+
+def oldCollect(states):
+    coupons = []
+    for page_source in states:
+        page_coupons, more = goodrx.parseChromePage(page_source)
+        for possible_coupon in page_coupons:
+            if possible_coupon not in coupons:
+                coupons.append(possible_coupon)
+    return coupons
+
+
+def newCollect(states):
+    coupons = goodrx.CouponCollector()
+    rows_seen = 0
+    for page_source in states:
+        page_coupons, more = goodrx.parseChromePage(page_source, rows_seen)
+        rows_seen += len(page_coupons)
+        for possible_coupon in page_coupons:
+            coupons.add(possible_coupon)
+    return list(coupons)
+
+
+def oldDedupe(passes):
+    coupons = []
+    for page_coupons in passes:
+        for possible_coupon in page_coupons:
+            if possible_coupon not in coupons:
+                coupons.append(possible_coupon)
+    return coupons
+
+
+def newDedupe(passes):
+    coupons = goodrx.CouponCollector()
+    for page_coupons in passes:
+        for possible_coupon in page_coupons:
+            coupons.add(possible_coupon)
+    return list(coupons)
+
+
+def best(function, argument, repeat):
+    return min(timeit.repeat(lambda: function(argument), number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("page", nargs="?")
+    parser.add_argument("--per-click", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    per_click = args.per_click
+    repeat = args.repeat
+    page_source = loadPage(args.page)
+    states = pageStates(page_source, per_click)
+    passes = [goodrx.parseChromePage(page_source)[0] for page_source in states]
+
+    if oldCollect(states) != newCollect(states):
+        sys.exit("Old and new collection disagree")
+
+    rows = len(passes[-1])
+    print("%s rows, %s page states, %s rows per click" % (rows, len(states), per_click))
+    for name, old, new, argument in (
+            ("dedupe only", oldDedupe, newDedupe, passes),
+            ("parse + dedupe", oldCollect, newCollect, states)):
+        old_time = best(old, argument, repeat)
+        new_time = best(new, argument, repeat)
+        print("%-15s old %8.2f ms  new %8.2f ms  %5.1fx"
+              % (name, old_time * 1000, new_time * 1000, old_time / new_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Benchmark the memory held by results waiting in memory, before and after
+interning repeated strings and packing coupons.
+
+    python benchmarks/bench_memory.py [--lookups 20000] [--coupons 30]
+        [--drugs 200] [--zips 500]
+
+Builds, from a generated price page, what a long run keeps in memory for
+--lookups lookups: results held back by OrderedResults or remembered by
+LookupPlanner, the --resume done set and the --columnar row buffer.  Each
+is built the old way, with every row carrying its own strings, and the
+new way with shareDrug, PackedCoupons and references to the row's parts,
+and the memory each takes is measured with tracemalloc.  Python 3 only.
+"""
+import gc
+import argparse
+import tracemalloc
+
+from samplepage import loadPage
+import goodrx
+
+
+def fresh(text):
+    """A copy of text that isn't shared with anything, like a freshly
+    parsed string"""
+    if not isinstance(text, str) or not text:
+        return text
+    return (text + ".")[:-1]
+
+
+def freshDrug(n, drugs, zips):
+    """Lookup n's drug, each drug in each zip in turn"""
+    return goodrx.Drug(fresh("drug %s" % (n % drugs,)), fresh("tablet"), fresh("40mg"),
+                       fresh(str(30 + n // (drugs * zips))), fresh(""),
+                       fresh(str(10000 + n // drugs % zips)))
+
+
+def freshCoupons(page_coupons, n, count):
+    start = (n * 7) % max(1, len(page_coupons) - count)
+    return [goodrx.Coupon(fresh(coupon.price), fresh(coupon.store_name), fresh(coupon.method))
+            for coupon in page_coupons[start:start + count]]
+
+
+def oldResults(args):
+    lookups, page_coupons, count, drugs, zips, user_agent = args
+    return dict((n, (freshDrug(n, drugs, zips), user_agent, freshCoupons(page_coupons, n, count)))
+                for n in range(lookups))
+
+
+def newResults(args):
+    lookups, page_coupons, count, drugs, zips, user_agent = args
+    return dict((n, (goodrx.shareDrug(freshDrug(n, drugs, zips)), user_agent,
+                     goodrx.packCoupons(freshCoupons(page_coupons, n, count))))
+                for n in range(lookups))
+
+
+def oldDone(args):
+    lookups, page_coupons, count, drugs, zips, user_agent = args
+    return set(tuple(freshDrug(n, drugs, zips)) + (fresh(user_agent.browser),)
+               for n in range(lookups))
+
+
+def newDone(args):
+    lookups, page_coupons, count, drugs, zips, user_agent = args
+    return set(tuple(goodrx.share(value) for value in
+                     tuple(freshDrug(n, drugs, zips)) + (fresh(user_agent.browser),))
+               for n in range(lookups))
+
+
+def oldRows(args):
+    """The columnar buffer for one flush of FSYNC_EVERY lookups"""
+    lookups, page_coupons, count, drugs, zips, user_agent = args
+    rows = []
+    for n in range(goodrx.FSYNC_EVERY):
+        drug = freshDrug(n, drugs, zips)
+        for coupon in freshCoupons(page_coupons, n, count):
+            rows.append(list(drug) + [coupon.price, False, coupon.store_name, coupon.method,
+                                      user_agent.browser, user_agent.user_agent, "run", 0])
+    return rows
+
+
+def newRows(args):
+    lookups, page_coupons, count, drugs, zips, user_agent = args
+    rows = []
+    for n in range(goodrx.FSYNC_EVERY):
+        drug = goodrx.shareDrug(freshDrug(n, drugs, zips))
+        for coupon in goodrx.packCoupons(freshCoupons(page_coupons, n, count)):
+            rows.append((drug, coupon, user_agent.browser, user_agent.user_agent, 0))
+    return rows
+
+
+def measure(build, args):
+    """Bytes still allocated once build's result is made"""
+    gc.collect()
+    tracemalloc.start()
+    result = build(args)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--coupons", type=int, default=30)
+    parser.add_argument("--drugs", type=int, default=200)
+    parser.add_argument("--zips", type=int, default=500)
+    args = parser.parse_args()
+    lookups, count, drugs, zips = args.lookups, args.coupons, args.drugs, args.zips
+    page_coupons = goodrx.parseChromePageSoup(loadPage(rows=300))[0]
+    user_agent = goodrx.UserAgent("Chrome", goodrx.DEFAULT_USER_AGENTS["Chrome"])
+    args = (lookups, page_coupons, count, drugs, zips, user_agent)
+
+    print("%s lookups, %s coupons each, %s drugs, %s zips" % (lookups, count, drugs, zips))
+    for name, old, new, rows in (
+            ("held results", oldResults, newResults, lookups * count),
+            ("done set", oldDone, newDone, lookups),
+            ("columnar buffer", oldRows, newRows, goodrx.FSYNC_EVERY * count)):
+        old_size = measure(old, args)
+        new_size = measure(new, args)
+        print("%-16s old %8.1f MB %6.0f B/row  new %8.1f MB %6.0f B/row  %5.1fx"
+              % (name, old_size / 1048576.0, old_size / float(rows),
+                 new_size / 1048576.0, new_size / float(rows), old_size / float(new_size)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Benchmark the Chrome page parser backends against each other.
+
+Parses each page with every installed backend (html.parser always, lxml and
+selectolax when installed), checks they all return the same coupons as
+html.parser and prints the time per parse.
+
+    python benchmarks/bench_parsers.py [recorded_page.html ...] [--rows 300]
+        [--padding 0] [--repeat 10]
+
+Without recorded pages a generated page with --rows pharmacies is used,
+with --padding KB of other markup around the price list.
+"""
+import os
+import sys
+import timeit
+import argparse
+
+from samplepage import loadPage
+import goodrx
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pages", nargs="*")
+    parser.add_argument("--rows", type=int, default=300)
+    parser.add_argument("--padding", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    repeat = args.repeat
+    pages = [(os.path.basename(path), loadPage(path)) for path in args.pages] or \
+        [("generated %s rows" % (args.rows,), loadPage(rows=args.rows, padding=args.padding))]
+    backends = goodrx.availableParsers()
+    print("Backends: %s" % (", ".join(backends),))
+
+    for name, page_source in pages:
+        expected = goodrx.parseChromePageSoup(page_source)
+        print("\n%s (%s coupons, %s KB)" % (name, len(expected[0]), len(page_source) // 1024))
+        baseline = None
+        for backend in reversed(backends):
+            parser = goodrx.CHROME_PARSERS[backend]
+            if parser(page_source) != expected:
+                sys.exit("%s gives different coupons than html.parser on %s" % (backend, name))
+            seconds = min(timeit.repeat(lambda: parser(page_source), number=1, repeat=repeat))
+            baseline = baseline or seconds
+            print("  %-12s %8.2f ms  %5.1fx" % (backend, seconds * 1000, baseline / seconds))
+
+
+if __name__ == "__main__":
+    main()
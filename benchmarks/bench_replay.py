@@ -0,0 +1,118 @@
+"""Benchmark whole goodrx.py runs against recorded pages.
+
+Record the pages for an input once with a normal run:
+
+    python goodrx.py input.csv Chrome 10 --record fixtures
+
+then replay that input with each engine and worker count:
+
+    python benchmarks/bench_replay.py input.csv fixtures [--browsers Chrome]
+        [--engines selenium,http,async] [--workers 1,2,4] [--wait 10] [--rate 1000]
+
+A goodrx_replay.py server is started on a free port and goodrx.py is run
+against it headless once per engine and worker count, each time in a
+scratch directory with an empty cache.  Prints lookups and output rows per
+second, p50 and p95 seconds per lookup and the peak RSS of the goodrx.py
+process (the browsers are separate processes and aren't counted).  --rate
+lifts the async engine's requests per second limit, which is there for
+goodrx.com and not the replay server.  Needs os.wait4, so Linux or macOS.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+# Let the benchmark import goodrx.py from the directory above
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import goodrx_replay
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(share * (len(values) - 1)))]
+
+
+def runOnce(input_csv, browsers, wait, engine, workers, rate, replay_url):
+    """Runs goodrx.py once and returns its wall time, output rows, seconds
+    per lookup and peak RSS in MB"""
+    scratch = tempfile.mkdtemp(prefix="goodrx-bench-")
+    timings = os.path.join(scratch, "timings.jsonl")
+    command = [sys.executable, os.path.join(ROOT, "goodrx.py"),
+               os.path.abspath(input_csv), browsers, str(wait),
+               "--replay", replay_url, "--engine", engine, "--workers", str(workers),
+               "--rate", str(rate), "--timings", timings, "--headless", "--offline",
+               "--cache", os.path.join(scratch, "cache.sqlite"),
+               "--ua-store", os.path.join(scratch, "useragents.json")]
+    log_path = os.path.join(scratch, "goodrx.log")
+    with open(log_path, "w") as logfile:
+        start = time.time()
+        process = subprocess.Popen(command, cwd=scratch, stdout=logfile,
+                                   stderr=subprocess.STDOUT)
+        pid, status, usage = os.wait4(process.pid, 0)
+        seconds = time.time() - start
+    if status:
+        print("goodrx.py exited with status %s, see %s" % (status, log_path))
+
+    rows = 0
+    for output in glob.glob(os.path.join(scratch, "GoodRx-*.csv")):
+        with open(output) as outfile:
+            rows += max(0, sum(1 for line in outfile) - 1)
+    latencies = []
+    if os.path.exists(timings):
+        with open(timings) as infile:
+            latencies = [json.loads(line)["seconds"] for line in infile]
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    peak_mb = usage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)
+    return seconds, rows, latencies, peak_mb
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input_csv")
+    parser.add_argument("fixtures")
+    parser.add_argument("--browsers", default="Chrome")
+    parser.add_argument("--engines", default="selenium,http,async")
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--wait", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=1000)
+    args = parser.parse_args()
+    if not os.path.isdir(args.fixtures):
+        parser.error("%s isn't a fixture directory" % (args.fixtures,))
+    input_csv, fixtures = args.input_csv, args.fixtures
+    browsers, wait, rate = args.browsers, args.wait, args.rate
+    engines = args.engines.split(",")
+    worker_counts = [int(n) for n in args.workers.split(",")]
+    if "async" in engines and sys.version_info < (3, 7):
+        print("The async engine needs Python 3.7 or newer, skipping it")
+        engines.remove("async")
+
+    server = goodrx_replay.ReplayServer(fixtures).start()
+    print("Replaying %s recorded lookups from %s at %s"
+          % (len(server.fixtures.states), fixtures, server.url))
+    print("%-9s %7s %8s %7s %10s %8s %7s %7s %12s" % ("engine", "workers", "lookups",
+          "rows", "lookups/s", "rows/s", "p50 s", "p95 s", "peak RSS MB"))
+    for engine in engines:
+        for workers in worker_counts:
+            misses = server.misses
+            seconds, rows, latencies, peak_mb = runOnce(input_csv, browsers, wait,
+                engine, workers, rate, server.url)
+            print("%-9s %7s %8s %7s %10.2f %8.1f %7.2f %7.2f %12.1f"
+                  % (engine, workers, len(latencies), rows, len(latencies) / seconds,
+                     rows / seconds, percentile(latencies, 0.5),
+                     percentile(latencies, 0.95), peak_mb))
+            if server.misses > misses:
+                print("  %s requests weren't recorded in %s" % (server.misses - misses, fixtures))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Benchmark how quickly goodrx.py gets going.
+
+    python benchmarks/bench_startup.py [input.csv fixtures] [--engines http,selenium]
+        [--browsers Chrome] [--repeat 5]
+
+Prints the time to import goodrx in a fresh interpreter and which heavy
+dependencies that loaded (none should be, they're imported on first use),
+and the time for goodrx.py --help and for rejecting a bad command line.
+Given an input and a --record fixture directory it also runs goodrx.py
+against a goodrx_replay.py server once per engine and prints the time from
+starting the process to the first price page being requested, and to the
+end of the run.  The runs are --offline so User-Agents come from the
+defaults and not the network.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+
+# Let the benchmark import goodrx.py from the directory above
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import goodrx_replay
+
+HEAVY = ["selenium", "requests", "bs4", "lxml", "selectolax", "pyarrow", "fake_useragent",
+         "goodrx_replay"]
+IMPORT_SCRIPT = """
+import sys, time
+start = time.time()
+import goodrx
+print("%%.4f %%s" %% (time.time() - start,
+    ",".join(name for name in %r if name in sys.modules)))
+"""
+
+
+def best(seconds):
+    return min(seconds) if seconds else 0.0
+
+
+def timeCommand(command, repeat):
+    seconds = []
+    for n in range(repeat):
+        start = time.time()
+        with open(os.devnull, "w") as devnull:
+            subprocess.call(command, cwd=ROOT, stdout=devnull, stderr=devnull)
+        seconds.append(time.time() - start)
+    return best(seconds)
+
+
+def timeImport(repeat):
+    """Best time to import goodrx and the heavy modules it loaded"""
+    seconds = []
+    for n in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", IMPORT_SCRIPT % (HEAVY,)],
+                                         cwd=ROOT).decode("utf-8").split()
+        seconds.append(float(output[0]))
+        loaded = output[1] if len(output) > 1 else "none"
+    return best(seconds), loaded
+
+
+def timeFirstFetch(input_csv, browsers, engine, server):
+    """Seconds from starting goodrx.py to the replay server seeing its
+    first price page request, and to the run finishing"""
+    first = []
+    lock = threading.Lock()
+    count = server.count
+    def firstCount(hit):
+        with lock:
+            if not first:
+                first.append(time.time())
+        count(hit)
+    server.count = firstCount
+
+    scratch = tempfile.mkdtemp(prefix="goodrx-startup-")
+    command = [sys.executable, os.path.join(ROOT, "goodrx.py"),
+               os.path.abspath(input_csv), browsers, "10", "--replay", server.url,
+               "--engine", engine, "--headless", "--offline", "--workers", "1",
+               "--cache", os.path.join(scratch, "cache.sqlite"),
+               "--ua-store", os.path.join(scratch, "useragents.json")]
+    log_path = os.path.join(scratch, "goodrx.log")
+    with open(log_path, "w") as logfile:
+        start = time.time()
+        status = subprocess.call(command, cwd=scratch, stdout=logfile, stderr=subprocess.STDOUT)
+        total = time.time() - start
+    server.count = count
+    if status:
+        print("goodrx.py exited with status %s, see %s" % (status, log_path))
+    return (first[0] - start if first else None), total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input_csv", nargs="?")
+    parser.add_argument("fixtures", nargs="?")
+    parser.add_argument("--engines", default="http")
+    parser.add_argument("--browsers", default="Chrome")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    repeat = args.repeat
+    seconds, loaded = timeImport(repeat)
+    print("import goodrx          %7.1f ms  heavy modules loaded: %s" % (seconds * 1000, loaded))
+    print("goodrx.py --help       %7.1f ms" % (timeCommand(
+        [sys.executable, "goodrx.py", "--help"], repeat) * 1000,))
+    print("bad command line       %7.1f ms" % (timeCommand(
+        [sys.executable, "goodrx.py", "missing.csv", "Chrome"], repeat) * 1000,))
+
+    if not args.fixtures or not os.path.isdir(args.fixtures):
+        return
+    input_csv, fixtures = args.input_csv, args.fixtures
+    browsers = args.browsers
+    engines = args.engines.split(",")
+    server = goodrx_replay.ReplayServer(fixtures).start()
+    print("\n%-9s %16s %10s" % ("engine", "first fetch s", "run s"))
+    for engine in engines:
+        first, total = timeFirstFetch(input_csv, browsers, engine, server)
+        print("%-9s %16s %10.2f" % (engine, "never" if first is None else "%.3f" % (first,), total))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Price pages for the benchmarks.
+
+Builds a desktop (Chrome) price page in the markup parseChromePage reads, or
+loads a page saved from goodrx.com, and cuts it into the states the page goes
+through as "view more" is clicked.
+"""
+import os
+import sys
+import copy
+
+from bs4 import BeautifulSoup as bs
+
+# Let the benchmarks import goodrx.py from the directory above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+METHODS = ["Coupon", "Discount", "Cash", "Membership", "Online"]
+
+
+def pagePadding(kb):
+    """About kb KB of navigation markup, like the rest of a real page"""
+    links = "".join('<li><a href="/drug-%s">Drug %s</a><p>Compare prices<br>near you</p></li>'
+                    % (n, n) for n in range(kb * 1024 // 70))
+    return '<div class="nav"><ul>%s</ul></div>' % (links,)
+
+
+def chromePage(rows=300, padding=0):
+    """A desktop price page with rows pharmacies and padding KB of markup
+    around the price list"""
+    price_rows = []
+    for n in range(rows):
+        price = "Free" if n % 50 == 0 else "%.2f" % (4 + n * 0.37,)
+        price_rows.append(
+            '<div class="price-row">'
+            '<div class="store-name">Pharmacy %s</div>'
+            '<span class="font-weight-medium">$</span>'
+            '<span class="font-weight-medium">%s</span>'
+            '<button>Get %s</button>'
+            '</div>' % (n, price, METHODS[n % len(METHODS)]))
+    return ('<html><head><title>Lipitor prices</title></head><body>%s'
+            '<div class="header">Lowest prices near 53703</div>'
+            '<div class="prices"><div id="locationDetection"></div>%s'
+            '<div class="view-button">View more</div></div>%s'
+            '</body></html>' % (pagePadding(padding // 2), "".join(price_rows),
+                                pagePadding(padding - padding // 2)))
+
+
+def loadPage(path=None, rows=300, padding=0):
+    """The saved page at path, or a generated one with rows pharmacies"""
+    if not path:
+        return chromePage(rows, padding)
+    with open(path) as infile:
+        return infile.read()
+
+
+def pageStates(page_source, per_click=10):
+    """The page as it looks on first load and after each "view more" click,
+    showing per_click more price rows each time"""
+    soup = bs(page_source, "html.parser")
+    total = len(soup.find_all("div", class_="price-row"))
+    states = []
+    for shown in range(per_click, total + per_click, per_click):
+        state = copy.copy(soup)
+        for row in state.find_all("div", class_="price-row")[shown:]:
+            row.decompose()
+        states.append(str(state))
+    return states
@@ -2,23 +2,229 @@ import os
 import re
 import sys
 import csv
+import json
 import time
+import sqlite3
+import signal
+import argparse
+import importlib
 import logging
+import uuid
+import heapq
+import socket
 import datetime
+import threading
 import traceback
 import unicodedata
-from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+from collections import namedtuple, OrderedDict, deque
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
-import requests
-from bs4 import BeautifulSoup as bs
-from fake_useragent import UserAgent as UA
 
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
+
+class LazyImport(object):
+    """Stands in for a module, or a "module:name" in one, and imports it
+    the first time it's used, so runs that never need a dependency don't
+    pay for loading it.  Given several, the first one installed is used"""
+    def __init__(self, *candidates):
+        self.candidates = candidates
+        self.target = None
+
+
+    def load(self):
+        if self.target is None:
+            error = None
+            for candidate in self.candidates:
+                module, _, name = candidate.partition(":")
+                try:
+                    target = importlib.import_module(module)
+                except ImportError as e:
+                    error = e
+                    continue
+                self.target = getattr(target, name) if name else target
+                break
+            else:
+                raise error
+        return self.target
+
+
+    def installed(self):
+        try:
+            self.load()
+            return True
+        except ImportError:
+            return False
+
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+
+requests = LazyImport("requests")
+bs = LazyImport("bs4:BeautifulSoup")
+lxml_html = LazyImport("lxml.html")
+SelectolaxParser = LazyImport("selectolax.lexbor:LexborHTMLParser", "selectolax.parser:HTMLParser")
+pyarrow = LazyImport("pyarrow")
+# Its HTTP server modules are only wanted with --record and --replay
+goodrx_replay = LazyImport("goodrx_replay")
+
+webdriver = LazyImport("selenium.webdriver")
+By = LazyImport("selenium.webdriver.common.by:By")
+Options = LazyImport("selenium.webdriver.chrome.options:Options")
+WebDriverWait = LazyImport("selenium.webdriver.support.ui:WebDriverWait")
+EC = LazyImport("selenium.webdriver.support.expected_conditions")
+selenium_errors = LazyImport("selenium.common.exceptions")
+
+# Number of drug lookups a browser session serves before it is restarted
+MAX_PAGES_PER_SESSION = 50
+# A page counts as loaded once its DOM hasn't changed for this long
+DOM_STABLE_MS = 300
+# How often readiness conditions are polled, in seconds
+POLL_FREQUENCY = 0.1
+# Loading indicators that have to disappear before a page is ready
+SPINNER_CSS = ".spinner, .loading, .loading-spinner"
+# Reads the text of some fields from every row past a start row in one
+# WebDriver call.  innerText, like WebElement.text, leaves out hidden text.
+# Kept to ES3 so it runs in old Internet Explorer too
+ROWS_SCRIPT = """
+var container = document.querySelector(arguments[0]);
+if (!container) { return null; }
+var rows = container.querySelectorAll(arguments[1]);
+var fields = arguments[2];
+var found = [];
+for (var n = arguments[3]; n < rows.length; n++) {
+    var values = [];
+    for (var f = 0; f < fields.length; f++) {
+        var element = rows[n].querySelector(fields[f]);
+        values.push(element ? (element.innerText || "")
+            .replace(/^\\s+|\\s+$/g, "") : null);
+    }
+    found.push(values);
+}
+var more = arguments[4] ? document.querySelector(arguments[4]) !== null : false;
+return {"total": rows.length, "rows": found, "more": more};
+"""
+# URL patterns blocked for each kind of resource given to --block
+BLOCKABLE = OrderedDict([
+    ("images", ["*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico"]),
+    ("fonts", ["*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+               "*fonts.googleapis.com*", "*fonts.gstatic.com*", "*use.typekit.net*"]),
+    ("media", ["*.mp4", "*.webm", "*.mp3", "*.ogg", "*.m3u8"]),
+    ("trackers", ["*google-analytics.com*", "*googletagmanager.com*",
+                  "*doubleclick.net*", "*googlesyndication.com*", "*facebook.net*",
+                  "*hotjar.com*", "*newrelic.com*", "*nr-data.net*", "*optimizely.com*",
+                  "*segment.com*", "*segment.io*", "*quantserve.com*",
+                  "*scorecardresearch.com*", "*bing.com/bat*", "*criteo.com*"])])
+# Option suffix for per browser settings, e.g. --block-safari
+BROWSER_OPTIONS = {"Chrome": "chrome", "Internet Explorer": "ie", "Safari": "safari"}
+# Adds up what the current document and everything it loaded transferred
+PAGE_STATS_SCRIPT = """
+var timing = window.performance.timing;
+var entries = window.performance.getEntries ? window.performance.getEntries() : [];
+var bytes = 0;
+for (var n = 0; n < entries.length; n++) {
+    bytes += entries[n].transferSize || 0;
+}
+return {"bytes": bytes, "resources": entries.length,
+        "load": timing.loadEventEnd > 0 ? timing.loadEventEnd - timing.navigationStart : null};
+"""
+# Text goodrx.com shows instead of prices to visitors it thinks are bots
+BLOCKED_MARKERS = ["captcha", "access denied", "pardon our interruption",
+                   "are you a robot", "unusual traffic", "request blocked"]
+BLOCKED_SCRIPT = "return document.title + ' ' + "\
+    "(document.body ? document.body.innerText.slice(0, 5000) : '')"
+# Seconds before the first retry of a failed lookup, doubled for each one after
+RETRY_BACKOFF = 5
+# Browsers whose price pages can be parsed from plain HTTP responses
+HTTP_BROWSERS = ["Chrome"]
+# Successful waits per browser and phase that timeouts are worked out from,
+# how many are needed before they're trusted over the wait time argument,
+# and how many recent waits the timeout rate is taken over
+TIMEOUT_WINDOW = 200
+TIMEOUT_MIN_SAMPLES = 20
+TIMEOUT_RECENT = 20
+# Upper bounds in seconds of the phase histograms in --metrics-out
+METRIC_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+Drug = namedtuple("Drug",
+    ["drug_name",
+    "form",
+    "dosage",
+    "quantity",
+    "label_override",
+    "location"])
+UserAgent = namedtuple("UserAgent", ["browser", "user_agent"])
+Coupon = namedtuple("Coupon", ["price", "store_name", "method"])
+
+# Jobs waiting in the queue per worker, which bounds memory on huge inputs
+QUEUE_PER_WORKER = 4
+# Lookups handed to the async engine at a time
+ASYNC_BATCH = 500
+# Input rows read ahead and sorted by location so each zip is set once
+LOCATION_WINDOW = 1000
+# Finished lookups remembered for answering duplicate rows later in the input
+DEDUPE_MEMORY = 10000
+# Seconds a job claimed from a --work job store stays leased without the
+# claiming process renewing it, how many leases a job gets before it's
+# marked failed, and how often store processes check on each other
+LEASE_SECONDS = 600
+LEASE_ATTEMPTS = 3
+STORE_POLL = 10
+# --serve waits this many seconds after a lookup comes in for more to batch
+# with it, and turns requests away once this many lookups are in flight
+SERVICE_BATCH_WAIT = 0.05
+SERVICE_MAX_PENDING = 1000
+# Output is fsynced after this many lookups or this many seconds
+FSYNC_EVERY = 25
+FSYNC_SECONDS = 10
+# --history rechecks a lookup whose prices changed last time after
+# --recheck-min hours, stretching towards --recheck-max as its prices stay
+# put.  Volatility is a moving average of how often checks find a change
+HISTORY_SMOOTHING = 0.3
+
+CSV_HEADER = [
+    "Drug Name",
+    "Form",
+    "Dosage",
+    "Quantity",
+    "Label Override",
+    "Zip/Location",
+    "Price",
+    "Store",
+    "Method",
+    "Browser",
+    "User-Agent"]
+
+CHANGES_HEADER = [
+    "Change",
+    "Drug Name",
+    "Form",
+    "Dosage",
+    "Quantity",
+    "Zip/Location",
+    "Store",
+    "Method",
+    "Browser",
+    "Old Price",
+    "New Price"]
+
+# Used when there's no stored User-Agent and none could be looked up
+DEFAULT_USER_AGENTS = {
+    "Safari": "Mozilla/5.0 (iPhone; CPU iPhone OS 5_1_1 like "\
+        "Mac OS X) AppleWebKit/534.46 (KHTML, like Gecko) Version/5.1 "\
+        "Mobile/9B206 Safari/7534.48.3",
+    "Internet Explorer": "Mozilla/4.0 (compatible; MSIE 8.0; Windows NT 6.1; "\
+        "WOW64; Trident/4.0; SLCC2; .NET CLR 2.0.50727; Media "\
+        "Center PC 6.0; .NET CLR 3.5.30729; .NET CLR 3.0.30729; .NET4.0C)",
+    "Chrome": "Mozilla/5.0 (X11; CrOS i686 4319.74.0) AppleWebKit/537.36 "\
+        "(KHTML, like Gecko) Chrome/29.0.1547.57 Safari/537.36"}
 
 def setupLogger():
     # Set up logging
@@ -33,12 +239,196 @@ def setupLogger():
 
 def setupWaitTime():
     global wait
+    wait = getArgument("wait", 5)
+    logging.info("Using wait time of %s" % (str(wait)))
+
+def setupJobStore():
+    """--coordinate, --work and --merge share a job store between machines"""
+    global job_store
+    job_store = None
+    path = getOption("coordinate") or getOption("work") or getOption("merge")
+    if not path:
+        return
+    lease = getOption("lease", LEASE_SECONDS)
     try:
-        wait = int(sys.argv[3])
-        logging.info("Using wait time of %s" % (str(wait)))
-    except:
-        wait = 5
-        logging.info("No wait time supplied, using default of 5 seconds")
+        job_store = JobStore(path, lease)
+    except Exception as e:
+        log.error(traceback.format_exc())
+        log.error("Unable to open job store %s" % (path,))
+        sys.exit()
+    log.info("Using job store %s" % (path,))
+
+def setupService():
+    """--serve PORT keeps running and answers price lookups over HTTP"""
+    global service_port, service_host, service_max_pending, service_timeout
+    service_port = None
+    if not hasOption("serve"):
+        return
+    service_port = getOption("serve")
+    service_max_pending = max(1, getOption("max-pending", SERVICE_MAX_PENDING))
+    service_timeout = getOption("request-timeout", 300)
+    service_host = getOption("host", "127.0.0.1")
+
+def setupRetries():
+    global retry_queue
+    retries = max(0, getOption("retries", 2))
+    retry_queue = RetryQueue(retries + 1)
+
+def setupTimeouts():
+    global timeouts
+    floor = getOption("wait-floor", 1)
+    ceiling = getOption("wait-ceiling", wait * 3)
+    percentile = getOption("wait-percentile", 95)
+    timeouts = AdaptiveTimeouts(floor, max(floor, ceiling), percentile,
+                                fixed=hasOption("fixed-wait"))
+    if not hasOption("fixed-wait"):
+        log.info("Adapting timeouts between %ss and %ss" % (floor, max(floor, ceiling)))
+
+# The command line once parseArguments has checked it
+arguments = None
+
+def getOption(name, default=None):
+    """Return the value given for --name, already converted to its type, or
+    default.  Everything is a default until parseArguments has run, e.g.
+    when goodrx is imported by the benchmarks"""
+    if arguments is None:
+        return default
+    value = getattr(arguments, name.replace("-", "_"))
+    return default if value is None else value
+
+def hasOption(name):
+    value = getOption(name)
+    return value is not None and value is not False
+
+def getArgument(name, default=None):
+    """The positional argument name, or default"""
+    return getOption(name, default)
+
+# Every option that takes a value and what it has to be, and every option
+# on its own.  getOption and hasOption only know the options listed here
+VALUE_OPTIONS = [
+    ("workers", int), ("engine", ["selenium", "http", "async"]), ("concurrency", int),
+    ("rate", float), ("parser", ["auto", "selectolax", "lxml", "html.parser"]),
+    ("location-window", int), ("retries", int), ("wait-floor", float),
+    ("wait-ceiling", float), ("wait-percentile", float), ("cache", str),
+    ("cache-ttl", float), ("cache-size", float), ("history", str),
+    ("recheck-min", float), ("recheck-max", float), ("resume", str),
+    ("columnar", ["parquet", "arrow"]), ("ua-store", str), ("ua-refresh", float),
+    ("ua-budget", float), ("block", str), ("record", str), ("replay", str),
+    ("timings", str), ("metrics-out", str), ("coordinate", str), ("work", str),
+    ("merge", str), ("lease", float), ("serve", int), ("host", str),
+    ("max-pending", int), ("request-timeout", float)] + [
+    ("block-" + suffix, str) for suffix in sorted(BROWSER_OPTIONS.values())]
+FLAG_OPTIONS = ["headless", "offline", "refresh", "cache-only", "fixed-wait", "recheck-all"]
+
+def browserList(value):
+    if not any(browser in value for browser in BROWSER_OPTIONS):
+        raise argparse.ArgumentTypeError("needs Chrome, Internet Explorer and/or Safari")
+    return value
+
+def parseArguments(argv=None):
+    """Checks the command line before anything is imported or fetched and
+    exits with usage if it's wrong.  getOption, hasOption and getArgument
+    read what it parsed from then on"""
+    global arguments
+    settings = {"allow_abbrev": False} if sys.version_info >= (3, 5) else {}
+    parser = argparse.ArgumentParser(prog="goodrx.py", epilog="The options are described "\
+        "in README.md", description="Looks up drug prices on goodrx.com", **settings)
+    parser.add_argument("csv", help="input csv, or - with --serve or --work")
+    parser.add_argument("browsers", type=browserList,
+                        help="Chrome, Internet Explorer and/or Safari")
+    parser.add_argument("wait", type=int, nargs="?", default=5,
+                        help="seconds to wait for pages, default 5")
+    for name, kind in VALUE_OPTIONS:
+        if isinstance(kind, list):
+            parser.add_argument("--" + name, choices=kind)
+        else:
+            parser.add_argument("--" + name, type=kind, metavar=kind.__name__.upper())
+    for name in FLAG_OPTIONS:
+        parser.add_argument("--" + name, action="store_true")
+    args = parser.parse_args(argv)
+
+    modes = [mode for mode in ("serve", "coordinate", "work", "merge")
+             if getattr(args, mode) is not None]
+    if len(modes) > 1:
+        parser.error("choose one of --%s" % (", --".join(modes),))
+    if not set(modes) & set(["serve", "work"]) and not os.path.isfile(args.csv):
+        parser.error("can't find the input csv %s" % (args.csv,))
+    if args.cache_only and args.refresh:
+        parser.error("--cache-only and --refresh together would never find a price")
+    if args.cache_only and args.history:
+        parser.error("--history needs fresh prices, it can't be used with --cache-only")
+    arguments = args
+    return args
+
+def setupWorkers():
+    global workers
+    workers = max(1, getOption("workers", 1))
+    log.info("Using %s worker browser(s)" % (workers,))
+
+def setupEngine():
+    global engine
+    engine = getOption("engine", "selenium")
+    if engine == "async" and sys.version_info < (3, 7):
+        log.error("The async engine needs Python 3.7 or newer, using http")
+        engine = "http"
+    if engine == "async":
+        try:
+            import goodrx_async
+        except ImportError as e:
+            log.error("The async engine needs aiohttp (pip install aiohttp), using http: %s" % (e,))
+            engine = "http"
+    log.info("Using %s engine" % (engine,))
+
+def setupParser():
+    """The parser is picked when the first Chrome page comes in, so runs
+    that never parse one don't import lxml or selectolax"""
+    global chrome_parser, parser_choice
+    chrome_parser = None
+    parser_choice = getOption("parser", "auto")
+
+def setupLocationWindow():
+    global location_window
+    location_window = max(1, getOption("location-window", LOCATION_WINDOW))
+
+def setupAsyncLimits():
+    global concurrency, rate
+    concurrency = max(1, getOption("concurrency", 200))
+    rate = max(0.1, getOption("rate", 10))
+
+def setupReplay():
+    """--record saves every price page to a fixture directory and --replay
+    loads them from a goodrx_replay.py server instead of goodrx.com"""
+    global recorder, replay_base, engine
+    replay_base = getOption("replay")
+    record_dir = getOption("record")
+    if replay_base and record_dir:
+        log.error("Can't --record and --replay at once, only replaying")
+        record_dir = None
+    if replay_base:
+        replay_base = replay_base.rstrip("/")
+        log.info("Replaying recorded pages from %s" % (replay_base,))
+    if record_dir:
+        try:
+            recorder = goodrx_replay.Recorder(record_dir)
+        except Exception as e:
+            log.error(traceback.format_exc())
+            log.error("Unable to record to %s" % (record_dir,))
+            sys.exit()
+        log.info("Recording pages to %s" % (record_dir,))
+        if engine == "async":
+            log.error("The async engine can't record pages, using http")
+            engine = "http"
+
+def setupMetrics():
+    path = getOption("timings")
+    if path:
+        try:
+            metrics.open(path)
+        except Exception as e:
+            log.error(traceback.format_exc())
+            log.error("Unable to write lookup times to %s" % (path,))
+            sys.exit()
 
 def is_number(s):
     try:
@@ -77,37 +467,855 @@ def processStore(store):
         return "Name Hidden"
     return store
 
+class WaitTimer():
+    """Adds up time spent waiting on pages and time spent on lookups overall,
+    across all worker threads"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiting = 0.0
+        self.busy = 0.0
+
+
+    def addWait(self, seconds):
+        with self.lock:
+            self.waiting += seconds
+
+
+    def addBusy(self, seconds):
+        with self.lock:
+            self.busy += seconds
+
+
+    def report(self):
+        working = max(self.busy - self.waiting, 0.0)
+        share = 100.0 * self.waiting / self.busy if self.busy else 0.0
+        log.info("Spent %.1fs waiting on pages and %.1fs working (%.0f%% waiting)"
+                 % (self.waiting, working, share))
+
+wait_timer = WaitTimer()
+
+
+class RunCounters():
+    """Named counters shared by all worker threads, logged at the end"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = OrderedDict()
+
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+
+    def get(self, name):
+        return self.counts.get(name, 0)
+
+
+    def report(self):
+        for name, count in self.counts.items():
+            log.info("%s: %s" % (name, count))
+
+counters = RunCounters()
+
+
+class PageStats():
+    """Bytes transferred and load time of each price page, per browser"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.browsers = OrderedDict()
+
+
+    def record(self, session):
+        try:
+            stats = session.driver.execute_script(PAGE_STATS_SCRIPT)
+        except Exception as e:
+            log.error("Couldn't read page stats from %s browser" % (session.browser,))
+            return
+        with self.lock:
+            totals = self.browsers.setdefault(session.browser, [0, 0, 0, 0])
+            totals[0] += 1
+            totals[1] += stats["bytes"]
+            totals[2] += stats["resources"]
+            if stats["load"] is not None:
+                totals[3] += stats["load"]
+
+
+    def report(self):
+        for browser, (pages, transferred, resources, load_ms) in self.browsers.items():
+            log.info("%s: %s pages, %.0f KB and %.0f requests per page, %.0f ms average load"
+                     % (browser, pages, transferred / 1024.0 / pages,
+                        float(resources) / pages, float(load_ms) / pages))
+
+page_stats = PageStats()
+
+
+class PhaseMetrics():
+    """Seconds spent in each phase of a lookup (driver start, location,
+    load, click, parse, csv write, ...) per browser, kept as histograms.
+    Phases timed on a worker thread between begin and end also go into that
+    lookup's line in the --timings file, tagged with the drug"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.phases = OrderedDict()
+        self.outfile = None
+
+
+    def open(self, path):
+        self.outfile = open(path, "w")
+
+
+    def add(self, browser, phase, seconds):
+        with self.lock:
+            totals = self.phases.get((phase, browser))
+            if totals is None:
+                totals = self.phases[(phase, browser)] = [0, 0.0, 0.0, [0] * len(METRIC_BUCKETS)]
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+            for n, bound in enumerate(METRIC_BUCKETS):
+                if seconds <= bound:
+                    totals[3][n] += 1
+        lookup = getattr(self.local, "lookup", None)
+        if lookup is not None:
+            lookup[phase] = round(lookup.get(phase, 0) + seconds, 4)
+            if phase == "click":
+                lookup["clicks"] = lookup.get("clicks", 0) + 1
+
+
+    def begin(self):
+        """Starts collecting the phases this thread times into one lookup"""
+        self.local.lookup = OrderedDict()
+
+
+    def end(self, drug, browser, source, seconds):
+        phases = getattr(self.local, "lookup", None) or OrderedDict()
+        self.local.lookup = None
+        self.add(browser, "lookup", seconds)
+        if not self.outfile:
+            return
+        line = json.dumps({"drug": list(drug), "browser": browser, "source": source,
+                           "seconds": round(seconds, 4), "phases": phases})
+        with self.lock:
+            self.outfile.write(line + "\n")
+
+
+    def close(self):
+        if self.outfile:
+            self.outfile.close()
+
+
+    def report(self):
+        """Logs the phases by total time, largest first"""
+        for (phase, browser), (count, total, longest, buckets) in sorted(
+                self.phases.items(), key=lambda item: -item[1][1]):
+            if phase != "lookup":
+                log.info("%s %s: %.1fs over %s, %.2fs average, %.2fs longest"
+                         % (browser, phase, total, count, total / count, longest))
+
+
+    def summary(self):
+        return {"phases": [{"phase": phase, "browser": browser, "count": count,
+                            "seconds": round(total, 4), "average": round(total / count, 4),
+                            "longest": round(longest, 4),
+                            "buckets": OrderedDict(zip([str(bound) for bound in METRIC_BUCKETS],
+                                                       buckets))}
+                           for (phase, browser), (count, total, longest, buckets)
+                           in self.phases.items()],
+                "counters": counters.counts}
+
+
+    def prometheus(self):
+        def label(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        lines = ["# HELP goodrx_phase_seconds Seconds spent in each phase of a lookup",
+                 "# TYPE goodrx_phase_seconds histogram"]
+        for (phase, browser), (count, total, longest, buckets) in self.phases.items():
+            labels = 'phase="%s",browser="%s"' % (label(phase), label(browser))
+            for bound, in_bucket in zip(METRIC_BUCKETS, buckets):
+                lines.append('goodrx_phase_seconds_bucket{%s,le="%s"} %s' % (labels, bound, in_bucket))
+            lines.append('goodrx_phase_seconds_bucket{%s,le="+Inf"} %s' % (labels, count))
+            lines.append('goodrx_phase_seconds_sum{%s} %s' % (labels, total))
+            lines.append('goodrx_phase_seconds_count{%s} %s' % (labels, count))
+        lines.extend(["# HELP goodrx_events_total Things that happened during the run",
+                      "# TYPE goodrx_events_total counter"])
+        for name, count in counters.counts.items():
+            lines.append('goodrx_events_total{event="%s"} %s' % (label(name), count))
+        return "\n".join(lines) + "\n"
+
+
+    def save(self, path):
+        """Writes Prometheus text format when path ends in .prom, otherwise
+        a JSON summary"""
+        try:
+            with open(path, "w") as outfile:
+                if path.endswith(".prom"):
+                    outfile.write(self.prometheus())
+                else:
+                    json.dump(self.summary(), outfile, indent=2)
+            log.info("Wrote metrics to %s" % (path,))
+        except Exception as e:
+            log.error(traceback.format_exc())
+            log.error("Unable to write metrics to %s" % (path,))
+
+metrics = PhaseMetrics()
+recorder = None
+replay_base = None
+
+
+class AdaptiveTimeouts():
+    """Picks the timeout for each (browser, phase) from how long its recent
+    waits took: the percentile of the last TIMEOUT_WINDOW waits times margin,
+    kept between floor and ceiling.  The more of the last TIMEOUT_RECENT
+    waits timed out the longer it gets, up to 5x when all of them did.
+    Until TIMEOUT_MIN_SAMPLES waits have been seen the default is used.
+    A wait that timed out is kept as taking its whole timeout, whether or
+    not it was required.  Waits that aren't required, like a page that may
+    never stop changing, don't get longer for timing out and never go past
+    the default"""
+    def __init__(self, floor, ceiling, percentile=95, margin=1.5, fixed=False):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.percentile = percentile
+        self.margin = margin
+        self.fixed = fixed
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.recent = {}
+        self.timed_out = {}
+
+
+    def timeout(self, browser, phase, default, required=True):
+        if self.fixed:
+            return default
+        key = (browser, phase)
+        with self.lock:
+            latencies = sorted(self.latencies.get(key, []))
+            recent = self.recent.get(key)
+            if len(latencies) >= TIMEOUT_MIN_SAMPLES:
+                position = int(len(latencies) * self.percentile / 100.0)
+                seconds = latencies[min(position, len(latencies) - 1)] * self.margin
+            else:
+                seconds = default
+            if not required:
+                return min(max(seconds, self.floor), default)
+            if recent:
+                seconds *= 1 + 4.0 * recent.count(True) / len(recent)
+        return min(max(seconds, self.floor), self.ceiling)
+
+
+    def observe(self, browser, phase, seconds, timed_out=False):
+        """A timed out wait took at least seconds, so it's kept as that"""
+        key = (browser, phase)
+        with self.lock:
+            if key not in self.latencies:
+                self.latencies[key] = deque(maxlen=TIMEOUT_WINDOW)
+                self.recent[key] = deque(maxlen=TIMEOUT_RECENT)
+                self.timed_out[key] = 0
+            self.latencies[key].append(seconds)
+            self.recent[key].append(timed_out)
+            if timed_out:
+                self.timed_out[key] += 1
+
+
+    def report(self):
+        if self.fixed:
+            return
+        for (browser, phase), latencies in sorted(self.latencies.items()):
+            log.info("%s %s: timeout now %.1fs, %s of %s waits timed out"
+                     % (browser, phase, self.timeout(browser, phase, wait),
+                        self.timed_out[(browser, phase)], len(latencies)))
+
+
+def waitFor(session, phase, condition, default=None, required=True):
+    """WebDriverWait.until on session's browser, with the timeout the
+    AdaptiveTimeouts pick for phase, booking its time on wait_timer.
+    default is the timeout to start from instead of the wait time argument.
+    When required is False a timeout isn't an error and False is returned
+    instead"""
+    timeout = timeouts.timeout(session.browser, phase, default or wait, required)
+    start = time.time()
+    try:
+        result = WebDriverWait(session.driver, timeout,
+                               poll_frequency=POLL_FREQUENCY).until(condition)
+        timeouts.observe(session.browser, phase, time.time() - start)
+        return result
+    except selenium_errors.TimeoutException:
+        timeouts.observe(session.browser, phase, time.time() - start, timed_out=True)
+        if required:
+            raise
+        return False
+    finally:
+        wait_timer.addWait(time.time() - start)
+
+
+class domStable(object):
+    """Condition that holds once the document has finished loading, no
+    spinner is showing and the element count hasn't changed for stable_ms"""
+    script = "return document.readyState == 'complete' && "\
+        "!Array.prototype.some.call(document.querySelectorAll(arguments[0]), "\
+        "function(e) { return e.offsetParent !== null; }) ? "\
+        "document.getElementsByTagName('*').length : -1"
+
+    def __init__(self, stable_ms=DOM_STABLE_MS):
+        self.stable_for = stable_ms / 1000.0
+        self.last_size = None
+        self.last_change = None
+
+    def __call__(self, driver):
+        size = driver.execute_script(self.script, SPINNER_CSS)
+        now = time.time()
+        if size != self.last_size:
+            self.last_size = size
+            self.last_change = now
+            return False
+        return size >= 0 and now - self.last_change >= self.stable_for
+
+
+class rowsIncreased(object):
+    """Condition that holds once more than previous elements match css, or
+    the button that loads more rows has gone away"""
+    def __init__(self, css, previous, button_css=None):
+        self.css = css
+        self.previous = previous
+        self.button_css = button_css
+
+    def __call__(self, driver):
+        if len(driver.find_elements_by_css_selector(self.css)) > self.previous:
+            return True
+        if self.button_css:
+            return not driver.find_elements_by_css_selector(self.button_css)
+        return False
+
+
+class ResultCache():
+    """SQLite cache of parsed coupons keyed like LookupPlanner, on lookupKey.
+    Entries expire after ttl seconds and the least recently used ones are
+    dropped once the stored coupons pass max_bytes"""
+    def __init__(self, path, ttl, max_bytes, refresh=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        self.hits = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS coupons (key TEXT PRIMARY KEY, "\
+            "coupons TEXT, size INTEGER, fetched REAL, accessed REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS coupons_accessed ON coupons (accessed)")
+        self.db.commit()
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM coupons").fetchone()[0]
+
+
+    def key(self, drug, browser):
+        return json.dumps(list(lookupKey(normalizeDrug(drug), browser)))
+
+
+    def get(self, drug, browser):
+        if self.refresh:
+            return None
+        key = self.key(drug, browser)
+        with self.lock:
+            row = self.db.execute("SELECT coupons, fetched FROM coupons WHERE key = ?",
+                                  (key,)).fetchone()
+            if not row or time.time() - row[1] > self.ttl:
+                return None
+            self.db.execute("UPDATE coupons SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+            self.hits += 1
+        return [Coupon(*coupon) for coupon in json.loads(row[0])]
+
+
+    def put(self, drug, browser, coupons):
+        """Empty results are usually a failed page load, so they aren't kept"""
+        if not coupons:
+            return
+        key = self.key(drug, browser)
+        value = json.dumps([list(coupon) for coupon in coupons])
+        now = time.time()
+        with self.lock:
+            old = self.db.execute("SELECT size FROM coupons WHERE key = ?", (key,)).fetchone()
+            if old:
+                self.size -= old[0]
+            self.db.execute("INSERT OR REPLACE INTO coupons VALUES (?, ?, ?, ?, ?)",
+                            (key, value, len(value), now, now))
+            self.size += len(value)
+            if self.size > self.max_bytes:
+                self.evict()
+            self.db.commit()
+
+
+    def evict(self):
+        """Drops least recently used entries until the cache is 10% under its limit"""
+        target = self.max_bytes * 0.9
+        evicted = 0
+        for key, size in self.db.execute("SELECT key, size FROM coupons "\
+                                         "ORDER BY accessed").fetchall():
+            if self.size <= target:
+                break
+            self.db.execute("DELETE FROM coupons WHERE key = ?", (key,))
+            self.size -= size
+            evicted += 1
+        log.info("Evicted %s entries from the cache" % (evicted,))
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def setupCache():
+    global cache, cache_only
+    cache_only = hasOption("cache-only")
+    ttl = getOption("cache-ttl", 6) * 3600
+    max_bytes = getOption("cache-size", 200) * 1024 * 1024
+    path = getOption("cache", "goodrx-cache.sqlite")
+    try:
+        cache = ResultCache(path, ttl, max_bytes, refresh=hasOption("refresh"))
+        log.info("Using result cache %s" % (path,))
+    except Exception as e:
+        log.error(traceback.format_exc())
+        log.error("Unable to open result cache %s, running without it" % (path,))
+        cache = None
+        if cache_only:
+            sys.exit()
+
+
+class PriceHistory():
+    """SQLite file with the last price seen for every coupon, keyed on the
+    drug fields except label_override plus store, method and browser, and
+    how volatile each lookup's prices have been.  Lookups whose prices
+    keep still are checked less often, see due()"""
+    def __init__(self, path, min_interval, max_interval):
+        self.path = path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.skipped = 0
+        self.changes = {"new": 0, "changed": 0, "removed": 0}
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS prices (drug_name TEXT, form TEXT, "\
+            "dosage TEXT, quantity TEXT, location TEXT, browser TEXT, store_name TEXT, "\
+            "method TEXT, price TEXT, first_seen REAL, last_seen REAL, PRIMARY KEY "\
+            "(drug_name, form, dosage, quantity, location, browser, store_name, method))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS lookups (drug_name TEXT, form TEXT, "\
+            "dosage TEXT, quantity TEXT, location TEXT, browser TEXT, checks INTEGER, "\
+            "changes INTEGER, volatility REAL, checked REAL, PRIMARY KEY "\
+            "(drug_name, form, dosage, quantity, location, browser))")
+        self.db.commit()
+
+
+    def key(self, drug, browser):
+        return lookupKey(normalizeDrug(drug), browser)
+
+
+    def interval(self, volatility):
+        """Seconds between checks, min_interval for prices that change every
+        time and longer the rarer changes are"""
+        return min(self.max_interval, self.min_interval / max(volatility, 0.0001))
+
+
+    def due(self, drug, browser):
+        """True for lookups never checked or whose interval has passed"""
+        with self.lock:
+            row = self.db.execute("SELECT volatility, checked FROM lookups WHERE drug_name = ? "\
+                "AND form = ? AND dosage = ? AND quantity = ? AND location = ? AND browser = ?",
+                self.key(drug, browser)).fetchone()
+        if row is None or time.time() - row[1] >= self.interval(row[0]):
+            return True
+        self.skipped += 1
+        return False
+
+
+    def update(self, drug, browser, coupons):
+        """Stores a lookup's coupons and returns how they differ from last
+        time as (change, store_name, method, old price, new price) with
+        change new, changed or removed.  Checks made before the lookup was
+        due, e.g. duplicate rows or --recheck-all, don't move its schedule"""
+        key = self.key(drug, browser)
+        match = "drug_name = ? AND form = ? AND dosage = ? AND quantity = ? "\
+            "AND location = ? AND browser = ?"
+        current = OrderedDict(((coupon.store_name, coupon.method), str(coupon.price))
+                              for coupon in coupons)
+        changes = []
+        now = time.time()
+        with self.lock:
+            known = dict(((store_name, method), price) for store_name, method, price in
+                self.db.execute("SELECT store_name, method, price FROM prices WHERE " + match, key))
+            for (store_name, method), price in current.items():
+                old = known.pop((store_name, method), None)
+                if old is None:
+                    changes.append(("new", store_name, method, "", price))
+                elif old != price:
+                    changes.append(("changed", store_name, method, old, price))
+                self.db.execute("INSERT OR IGNORE INTO prices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                key + (store_name, method, price, now, now))
+                self.db.execute("UPDATE prices SET price = ?, last_seen = ? WHERE " + match +
+                                " AND store_name = ? AND method = ?",
+                                (price, now) + key + (store_name, method))
+            for (store_name, method), price in known.items():
+                changes.append(("removed", store_name, method, price, ""))
+                self.db.execute("DELETE FROM prices WHERE " + match + " AND store_name = ? "\
+                                "AND method = ?", key + (store_name, method))
+
+            row = self.db.execute("SELECT checks, changes, volatility, checked FROM lookups "\
+                                  "WHERE " + match, key).fetchone()
+            if row is None:
+                # Nothing to compare the first check with, start out volatile
+                self.db.execute("INSERT INTO lookups VALUES (?, ?, ?, ?, ?, ?, 1, 0, 1.0, ?)",
+                                key + (now,))
+            elif now - row[3] >= self.interval(row[2]):
+                volatility = (1 - HISTORY_SMOOTHING) * row[2] + HISTORY_SMOOTHING * bool(changes)
+                self.db.execute("UPDATE lookups SET checks = ?, changes = ?, volatility = ?, "\
+                                "checked = ? WHERE " + match,
+                                (row[0] + 1, row[1] + bool(changes), volatility, now) + key)
+            self.db.commit()
+            if row is None:
+                # Every coupon is new the first time, which isn't news
+                return []
+            for change in changes:
+                self.changes[change[0]] += 1
+        return changes
+
+
+    def report(self):
+        log.info("Price history: %s new, %s changed and %s removed coupons, %s lookups "\
+                 "skipped as not due" % (self.changes["new"], self.changes["changed"],
+                                         self.changes["removed"], self.skipped))
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def setupHistory():
+    """--history keeps every price seen and only rechecks lookups when
+    they're due, see PriceHistory"""
+    global history, recheck_all
+    history = None
+    recheck_all = hasOption("recheck-all")
+    path = getOption("history")
+    if not path:
+        return
+    min_interval = getOption("recheck-min", 6) * 3600
+    max_interval = getOption("recheck-max", 168) * 3600
+    try:
+        history = PriceHistory(path, min_interval, max(min_interval, max_interval))
+    except Exception as e:
+        log.error(traceback.format_exc())
+        log.error("Unable to open price history %s" % (path,))
+        sys.exit()
+    log.info("Using price history %s" % (path,))
+
+
+class ColumnarWriter():
+    """Writes the output rows as Parquet or an Arrow IPC stream next to the
+    csv.  Prices are decimals with price_missing set where the page had
+    none, the repetitive text columns are dictionary encoded and every row
+    carries the run id and the time it was written.  Rows are buffered and
+    written out as a row group (a record batch for Arrow) on each flush"""
+    schema_fields = [
+        ("drug_name", "string"),
+        ("form", "string"),
+        ("dosage", "string"),
+        ("quantity", "string"),
+        ("label_override", "string"),
+        ("location", "string"),
+        ("price", "price"),
+        ("price_missing", "bool"),
+        ("store", "dictionary"),
+        ("method", "dictionary"),
+        ("browser", "dictionary"),
+        ("user_agent", "dictionary"),
+        ("run_id", "dictionary"),
+        ("written_at", "timestamp")]
+
+    def __init__(self, path, output_format, run_id):
+        types = {"string": pyarrow.string(),
+                 "price": pyarrow.decimal128(12, 2),
+                 "bool": pyarrow.bool_(),
+                 "dictionary": pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+                 "timestamp": pyarrow.timestamp("ms", tz="UTC")}
+        self.schema = pyarrow.schema([(name, types[kind]) for name, kind in self.schema_fields])
+        self.path = path
+        self.output_format = output_format
+        self.run_id = run_id
+        self.rows = []
+        self.written = 0
+        if output_format == "parquet":
+            # pyarrow doesn't import its parquet module by itself
+            importlib.import_module("pyarrow.parquet")
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self.sink = pyarrow.OSFile(path, "wb")
+            self.writer = pyarrow.ipc.new_stream(self.sink, self.schema)
+
+
+    def price(self, price):
+        try:
+            return Decimal(str(price).replace(",", "")).quantize(Decimal("0.01"))
+        except InvalidOperation:
+            return None
+
+
+    def add(self, drug, coupon, browser, user_agent):
+        """Keeps references to the row's parts, expand() makes the row"""
+        self.rows.append((drug, coupon, browser, user_agent, datetime.datetime.utcnow()))
+
+
+    def expand(self, row):
+        drug, coupon, browser, user_agent, written_at = row
+        price = self.price(coupon.price)
+        return list(drug) + [price, price is None, coupon.store_name, coupon.method,
+                             browser, user_agent, self.run_id, written_at]
+
+
+    def flush(self):
+        if not self.rows:
+            return
+        rows = [self.expand(row) for row in self.rows]
+        columns = []
+        for n, (name, kind) in enumerate(self.schema_fields):
+            values = [row[n] for row in rows]
+            if kind == "dictionary":
+                columns.append(pyarrow.array(values, pyarrow.string()).dictionary_encode())
+            else:
+                columns.append(pyarrow.array(values, self.schema.field(name).type))
+        batch = pyarrow.RecordBatch.from_arrays(columns, schema=self.schema)
+        if self.output_format == "parquet":
+            self.writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+        self.written += len(self.rows)
+        self.rows = []
+
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        if self.output_format == "arrow":
+            self.sink.close()
+
+
+def openCsv(path, mode):
+    """csv wants binary files on Python 2 and newline='' text on Python 3"""
+    if sys.version_info[0] < 3:
+        return open(path, mode + "b")
+    return open(path, mode, newline="")
+
+def truncateFile(path, size):
+    """Cuts path down to size bytes if it's longer"""
+    if os.path.exists(path) and os.path.getsize(path) > size:
+        log.info("Dropping %s bytes of %s written after the last finished lookup"
+                 % (os.path.getsize(path) - size, path))
+        with open(path, "r+b") as partial:
+            partial.truncate(size)
+
+def headerSize(path):
+    """Bytes in path's first line, or None when there's no whole one"""
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as existing:
+        header = existing.readline()
+    return len(header) if header.endswith(b"\n") else None
+
 class CSV():
     def __init__(self):
-        self.to_csv = []
-        self.csvToDrug()
+        self.bad_rows = 0
+        try:
+            self.csv_input = getArgument("csv")
+            with openCsv(self.csv_input, "r") as csvfile:
+                pass
+        except Exception as e:
+            log.error(traceback.format_exc())
+            log.error("Unable to open csv input file")
+            sys.exit()
+        self.openOutput()
 
 
     def csvToDrug(self):
-        self.drugs = []
-        Drug = namedtuple("Drug",
-            ["drug_name",
-            "form",
-            "dosage",
-            "quantity",
-            "label_override",
-            "location"])
+        """Yields a Drug for each valid input row as it's read, so scraping
+        can start before the whole file has been looked at.  Rows that can't
+        be used are logged and skipped"""
+        line_num = 0
         try:
-            csv_input = sys.argv[1]
-            with open(csv_input, "rb") as csvfile:
+            with openCsv(self.csv_input, "r") as csvfile:
                 raw_csv = csv.reader(csvfile)
                 for n, row in enumerate(raw_csv):
-                    if n == 0:
+                    line_num = raw_csv.line_num
+                    if n == 0 or not row:
                         continue
-                    self.drugs.append(Drug(row[0],row[1],row[2],row[3],row[4],row[5]))
+                    problem = self.checkRow(row)
+                    if problem:
+                        self.bad_rows += 1
+                        log.error("Skipping input line %s (%s): %s" % (line_num, problem, row))
+                        continue
+                    yield shareDrug(row[:6])
         except Exception as e:
             log.error(traceback.format_exc())
-            log.error("Unable to open csv input file")
+            log.error("Unable to read csv input file past line %s" % (line_num,))
+        if self.bad_rows:
+            log.error("Skipped %s bad input rows" % (self.bad_rows,))
+
+
+    def checkRow(self, row):
+        if len(row) < 6:
+            return "needs 6 columns, has %s" % (len(row),)
+        for column, name in ((0, "drug name"), (1, "form"), (2, "dosage"),
+                             (3, "quantity"), (5, "zip/location")):
+            if not row[column].strip():
+                return "missing %s" % (name,)
+        if not is_number(row[3].strip()):
+            return "quantity isn't a number"
+        return None
+
+
+    def openOutput(self):
+        """Opens the output csv plus a .done.jsonl sidecar that lists the
+        (Drug, browser) pairs already written and where in the csv their rows
+        end.  A new run starts both afresh.  With --resume the given output
+        is continued from its last finished pair and the pairs in it are
+        skipped"""
+        self.done = set()
+        self.unsynced = 0
+        self.last_sync = time.time()
+        resume = getOption("resume")
+        if resume:
+            self.file_destination = resume
+            self.loadProgress()
+        else:
+            self.file_destination = "GoodRx-%s.csv" % \
+                (datetime.datetime.now().strftime("%m-%d-%y-%H-%M"),)
+        mode = "a" if resume else "w"
+        try:
+            new_file = not resume or not os.path.exists(self.file_destination) or \
+                os.path.getsize(self.file_destination) == 0
+            if not new_file:
+                with open(self.file_destination, "rb") as existing:
+                    existing.seek(-1, os.SEEK_END)
+                    partial_row = existing.read(1) not in (b"\n", b"\r")
+            self.outfile = openCsv(self.file_destination, mode)
+            self.writer = csv.writer(self.outfile)
+            self.progress = open(self.file_destination + ".done.jsonl", mode)
+            if new_file:
+                self.writer.writerow(CSV_HEADER)
+            elif partial_row:
+                self.outfile.write("\r\n")
+        except Exception as e:
+            log.error(traceback.format_exc())
+            log.error("Error opening output file.  Check file writing permissions?")
             sys.exit()
+        log.info("Writing output to file %s" % (self.file_destination,))
+        self.openColumnar()
+        self.openChanges()
+
+
+    def openColumnar(self):
+        """With --columnar parquet or arrow the rows are also written to a
+        typed file named after the csv.  A resumed run gets its own file"""
+        self.columnar = None
+        output_format = getOption("columnar")
+        if not output_format:
+            return
+        if not pyarrow.installed():
+            log.error("--columnar needs pyarrow (pip install pyarrow), only writing csv")
+            return
+        run_id = uuid.uuid4().hex
+        root = os.path.splitext(self.file_destination)[0]
+        path = "%s.%s" % (root, output_format)
+        if os.path.exists(path):
+            path = "%s.%s.%s" % (root, run_id[:8], output_format)
+        try:
+            self.columnar = ColumnarWriter(path, output_format, run_id)
+        except Exception as e:
+            log.error(traceback.format_exc())
+            log.error("Unable to open %s, only writing csv" % (path,))
+            return
+        log.info("Also writing %s output to %s, run id %s" % (output_format, path, run_id))
+
+
+    def openChanges(self):
+        """With --history the coupons that are new, changed or gone since
+        the last check are also written to a -changes.csv next to the csv"""
+        self.changes = None
+        if not history:
+            return
+        self.changes_destination = "%s-changes.csv" % (os.path.splitext(self.file_destination)[0],)
+        resume = getOption("resume")
+        try:
+            new_file = not resume or not os.path.exists(self.changes_destination)
+            self.changes = openCsv(self.changes_destination, "a" if resume else "w")
+            self.changes_writer = csv.writer(self.changes)
+            if new_file:
+                self.changes_writer.writerow(CHANGES_HEADER)
+        except Exception as e:
+            log.error(traceback.format_exc())
+            log.error("Error opening changes file.  Check file writing permissions?")
+            sys.exit()
+        log.info("Writing price changes to file %s" % (self.changes_destination,))
+
+
+    def putChanges(self, drug, coupons, browser):
+        """Records a finished lookup's coupons in the price history"""
+        if not self.changes or not coupons:
+            return
+        drug = normalizeDrug(drug)
+        for change, store_name, method, old_price, new_price in history.update(drug, browser, coupons):
+            self.changes_writer.writerow([change, drug.drug_name, drug.form, drug.dosage,
+                drug.quantity, drug.location, store_name, method, browser, old_price, new_price])
+
+
+    def loadProgress(self):
+        """Reads the pairs already done.  Rows written after the last one
+        finished, by a run that died part way through a pair, are cut off the
+        csv, as is a half written last line of the sidecar"""
+        progress_file = self.file_destination + ".done.jsonl"
+        try:
+            if os.path.exists(progress_file):
+                kept = 0
+                end = None
+                with open(progress_file, "rb") as progress:
+                    for line in progress:
+                        try:
+                            if not line.endswith(b"\n"):
+                                raise ValueError("unfinished line")
+                            values = json.loads(line.decode("utf-8"))
+                        except ValueError:
+                            # Last line of a run that died mid-write
+                            break
+                        kept += len(line)
+                        # Sidecars from before offsets were recorded have none
+                        if len(values) > len(Drug._fields) + 1:
+                            end = values.pop()
+                        self.done.add(tuple(share(value) for value in values))
+                truncateFile(progress_file, kept)
+                if end is None and not self.done:
+                    # Died before finishing any pair, keep only the header
+                    end = headerSize(self.file_destination)
+                if end is not None:
+                    truncateFile(self.file_destination, end)
+            elif os.path.exists(self.file_destination):
+                with openCsv(self.file_destination, "r") as partial:
+                    for n, row in enumerate(csv.reader(partial)):
+                        if n == 0 or len(row) < len(CSV_HEADER):
+                            continue
+                        self.done.add(tuple(share(value) for value in row[:6] + [row[9]]))
+        except Exception as e:
+            log.error(traceback.format_exc())
+            log.error("Unable to read progress from %s" % (self.file_destination,))
+            sys.exit()
+        log.info("Resuming %s, %s lookups already done" % (self.file_destination, len(self.done)))
+
+
+    def isDone(self, drug, browser):
+        return tuple(drug) + (browser,) in self.done
 
 
     def putcsv(self, drug, coupon, browser, user_agent):
-        self.to_csv.append([
+        if self.columnar:
+            self.columnar.add(drug, coupon, browser, user_agent)
+        self.writer.writerow([
             drug.drug_name,
             drug.form,
             drug.dosage,
@@ -121,30 +1329,423 @@ class CSV():
             user_agent])
 
 
+    def markDone(self, drug, browser):
+        """Records that every row for this pair has been written.  Files are
+        flushed every time and fsynced every FSYNC_EVERY pairs or
+        FSYNC_SECONDS seconds"""
+        self.outfile.flush()
+        end = os.fstat(self.outfile.fileno()).st_size
+        self.progress.write(json.dumps(list(drug) + [browser, end]) + "\n")
+        self.progress.flush()
+        self.unsynced += 1
+        if self.unsynced >= FSYNC_EVERY or time.time() - self.last_sync >= FSYNC_SECONDS:
+            self.sync()
+
+
+    def sync(self):
+        if self.columnar:
+            self.columnar.flush()
+        for outfile in (self.outfile, self.progress, self.changes):
+            if outfile is None:
+                continue
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+
     def savecsv(self):
-        self.to_csv.insert(0,[
-            "Drug Name",
-            "Form",
-            "Dosage",
-            "Quantity",
-            "Label Override",
-            "Zip/Location",
-            "Price",
-            "Store",
-            "Method",
-            "Browser",
-            "User-Agent"])
-        file_destination = "GoodRx-%s.csv" % \
-            (datetime.datetime.now().strftime("%m-%d-%y-%H-%M"),)
         try:
-            with open(file_destination, "wb") as outfile:
-                writer = csv.writer(outfile)
-                writer.writerows(self.to_csv)
-                log.info("Wrote output to file %s" % (file_destination),)
+            self.sync()
+            self.outfile.close()
+            self.progress.close()
+            if self.changes:
+                self.changes.close()
+                history.report()
+            if self.columnar:
+                self.columnar.close()
+                log.info("Wrote %s rows to %s" % (self.columnar.written, self.columnar.path))
+            log.info("Wrote output to file %s" % (self.file_destination),)
         except Exception as e:
             log.error(traceback.format_exc())
             log.error("Error writing to file.  Check file writing permissions?")
 
+
+class OrderedResults():
+    """Streams each job's coupons to the csv as soon as every job before it
+    has finished, so output is written as it arrives but stays in input
+    order no matter which worker finishes first.  Job ids count up from 0"""
+    def __init__(self, csv_tool):
+        self.csv_tool = csv_tool
+        self.position = 0
+        self.finished = {}
+        self.lock = threading.Lock()
+
+
+    def add(self, job_id, drug, user_agent, coupons, failed=False):
+        """coupons of None means the job was skipped and isn't marked done.
+        failed means coupons are whatever a lookup that gave up collected,
+        which are written out but left out of the price history"""
+        with self.lock:
+            if job_id != self.position:
+                # Held back behind an earlier job
+                coupons = packCoupons(coupons)
+            self.finished[job_id] = (drug, user_agent, coupons, failed)
+            while self.position in self.finished:
+                drug, user_agent, coupons, failed = self.finished.pop(self.position)
+                self.position += 1
+                start = time.time()
+                for coupon in coupons or []:
+                    self.csv_tool.putcsv(drug, coupon, user_agent.browser, user_agent.user_agent)
+                # Empty results are usually failures, leave them for --resume
+                if coupons:
+                    if not failed:
+                        self.csv_tool.putChanges(drug, coupons, user_agent.browser)
+                    self.csv_tool.markDone(drug, user_agent.browser)
+                    metrics.add(user_agent.browser, "csv write", time.time() - start)
+
+
+    def finish(self, job_count):
+        """Writes out whatever is still held back behind a job that never
+        finished, e.g. because its worker died"""
+        with self.lock:
+            missing = [job_id for job_id in range(self.position, job_count)
+                       if job_id not in self.finished]
+        if missing:
+            log.error("%s lookups never finished, they will be retried by --resume" % (len(missing),))
+        for job_id in missing:
+            self.add(job_id, None, None, None)
+
+
+# Strings repeated across lookups, like store names, methods, zips and drug
+# fields, are interned so every result that has them shares one copy.
+# Python frees an interned string once nothing uses it, so nothing builds
+# up over a long --serve.  Python 3 moved intern into sys
+internString = getattr(sys, "intern", None) or intern
+
+def share(value):
+    """value interned if it's a str, anything else as it is"""
+    return internString(value) if type(value) is str else value
+
+def shareDrug(drug):
+    return Drug(*[share(value) for value in drug])
+
+
+class PackedCoupons(object):
+    """A lookup's coupons as columns, with store names and methods shared,
+    for results held in memory, instead of a Coupon and its own strings
+    per row.  Iterating gives Coupons back, so they're only expanded when
+    written out"""
+    __slots__ = ("prices", "stores", "methods")
+
+    def __init__(self, coupons):
+        self.prices = tuple(coupon.price for coupon in coupons)
+        self.stores = tuple(share(coupon.store_name) for coupon in coupons)
+        self.methods = tuple(share(coupon.method) for coupon in coupons)
+
+
+    def __len__(self):
+        return len(self.prices)
+
+
+    def __iter__(self):
+        for coupon in zip(self.prices, self.stores, self.methods):
+            yield Coupon(*coupon)
+
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def packCoupons(coupons):
+    """coupons as PackedCoupons, leaving None and already packed ones be"""
+    if coupons is None or isinstance(coupons, PackedCoupons):
+        return coupons
+    return PackedCoupons(coupons)
+
+
+def normalizeDrug(drug):
+    """Cleans up spacing, case and number formatting so rows asking for the
+    same lookup compare equal"""
+    quantity = drug.quantity.strip()
+    try:
+        if float(quantity) == int(float(quantity)):
+            quantity = str(int(float(quantity)))
+    except ValueError:
+        pass
+    location = " ".join(drug.location.split())
+    if re.match(r"^\d{5}-\d{4}$", location):
+        location = location[:5]
+    return Drug(" ".join(drug.drug_name.split()).lower(),
+                drug.form.strip().lower(),
+                "".join(drug.dosage.split()).lower(),
+                quantity,
+                drug.label_override.strip(),
+                location)
+
+
+def lookupKey(drug, browser):
+    """What a normalized drug's lookup is known by in a run, the cache and
+    the price history.  label_override doesn't change the prices"""
+    return (drug.drug_name, drug.form, drug.dosage, drug.quantity,
+            drug.location.lower(), browser)
+
+
+class LookupPlanner():
+    """Collapses rows that ask for the same lookup, ignoring label_override,
+    into a single fetch and fans the coupons back out to every row.  Sits in
+    front of OrderedResults and takes add() calls the same way"""
+    def __init__(self, results, remember=DEDUPE_MEMORY):
+        self.results = results
+        self.remember = remember
+        self.waiting = {}
+        self.leaders = {}
+        self.fetched = OrderedDict()
+        self.job_count = 0
+        self.saved = 0
+        self.lock = threading.Lock()
+
+
+    def key(self, drug, browser):
+        return lookupKey(drug, browser)
+
+
+    def plan(self, job):
+        """Returns the normalized job to fetch, or None when an earlier row
+        already covers it"""
+        job_id, drug, user_agent = job
+        normal = normalizeDrug(drug)
+        key = self.key(normal, user_agent.browser)
+        with self.lock:
+            self.job_count = job_id + 1
+            if key in self.waiting:
+                self.waiting[key].append(job)
+                self.saved += 1
+                return None
+            coupons = self.fetched.pop(key, None)
+            if coupons is None:
+                self.waiting[key] = [job]
+                self.leaders[job_id] = key
+                return (job_id, normal, user_agent)
+            self.fetched[key] = coupons
+            self.saved += 1
+        self.results.add(job_id, drug, user_agent, coupons)
+        return None
+
+
+    def add(self, job_id, drug, user_agent, coupons, failed=False):
+        coupons = packCoupons(coupons)
+        with self.lock:
+            key = self.leaders.pop(job_id)
+            rows = self.waiting.pop(key)
+            # Failures and empty results, which usually are failures, let
+            # later duplicates retry
+            if coupons and not failed:
+                self.fetched[key] = coupons
+                if len(self.fetched) > self.remember:
+                    self.fetched.popitem(last=False)
+        for row_id, row_drug, row_user_agent in rows:
+            self.results.add(row_id, row_drug, row_user_agent, coupons, failed)
+
+
+    def report(self):
+        log.info("Collapsed %s duplicate lookups into earlier fetches" % (self.saved,))
+
+
+class JobStore():
+    """SQLite file, e.g. on a shared volume, that a --coordinate process
+    fills with lookups and --work processes on any number of machines claim
+    and fill in.  Claimed jobs are leased; working processes keep renewing
+    their leases, so a lease only runs out when its process has died and the
+    job is then handed out again.  Takes add() calls like OrderedResults"""
+    def __init__(self, path, lease=LEASE_SECONDS):
+        self.path = path
+        self.lease = lease
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs (job_id INTEGER PRIMARY KEY, "\
+            "drug TEXT, location TEXT, browser TEXT, state TEXT, worker TEXT, "\
+            "lease_until REAL, leases INTEGER, user_agent TEXT, coupons TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, location)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+
+    def transaction(self, work, *args):
+        """Runs work(*args) holding the store's write lock"""
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                result = work(*args)
+                self.db.execute("COMMIT")
+            except Exception as e:
+                self.db.execute("ROLLBACK")
+                raise
+        return result
+
+
+    def queue(self, jobs):
+        """Adds (job_id, Drug, UserAgent) jobs, unless the store was filled
+        by an earlier run.  Each batch is committed on its own, so workers
+        can claim jobs while the rest are still being read, and the queued
+        mark goes in last.  Jobs a run that died part way already added are
+        left as they are.  Returns how many were added"""
+        def insert(batch):
+            return self.db.executemany("INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, ?, "\
+                "'pending', NULL, NULL, 0, NULL, NULL)", [(job_id, json.dumps(list(drug)),
+                drug.location.lower(), user_agent.browser)
+                for job_id, drug, user_agent in batch]).rowcount
+        if self.queued():
+            return 0
+        added = 0
+        for batch in batches(jobs, 1000):
+            added += self.transaction(insert, batch)
+        self.transaction(self.db.execute, "INSERT OR REPLACE INTO meta VALUES ('queued', ?)",
+                         (str(time.time()),))
+        return added
+
+
+    def queued(self):
+        """Whether every job has been added"""
+        with self.lock:
+            return self.db.execute("SELECT value FROM meta WHERE key = 'queued'").fetchone() \
+                is not None
+
+
+    def requeueExpired(self):
+        """Puts jobs whose lease ran out back in line, or marks them failed
+        after LEASE_ATTEMPTS leases.  Call inside a transaction"""
+        now = time.time()
+        self.db.execute("UPDATE jobs SET state = 'failed' WHERE state = 'leased' "\
+            "AND lease_until < ? AND leases >= ?", (now, LEASE_ATTEMPTS))
+        return self.db.execute("UPDATE jobs SET state = 'pending', worker = NULL "\
+            "WHERE state = 'leased' AND lease_until < ?", (now,)).rowcount
+
+
+    def requeue(self):
+        requeued = self.transaction(self.requeueExpired)
+        if requeued:
+            log.info("Requeued %s jobs whose lease ran out" % (requeued,))
+
+
+    def claim(self, worker_id, browsers, count):
+        """Leases up to count pending jobs for browsers, nearby zips together.
+        Returns (job_id, Drug, browser) for each"""
+        def lease():
+            requeued = self.requeueExpired()
+            rows = self.db.execute("SELECT job_id, drug, browser FROM jobs WHERE state = "\
+                "'pending' AND browser IN (%s) ORDER BY location, job_id LIMIT ?"
+                % (", ".join("?" * len(browsers)),), list(browsers) + [count]).fetchall()
+            self.db.executemany("UPDATE jobs SET state = 'leased', worker = ?, "\
+                "lease_until = ?, leases = leases + 1 WHERE job_id = ?",
+                [(worker_id, time.time() + self.lease, row[0]) for row in rows])
+            return requeued, rows
+        while True:
+            try:
+                requeued, rows = self.transaction(lease)
+                break
+            except sqlite3.OperationalError as e:
+                # Another process held the store for longer than the timeout
+                if "locked" not in str(e):
+                    raise
+                log.error("Job store %s is busy, trying again" % (self.path,))
+        if requeued:
+            log.info("Requeued %s jobs whose lease ran out" % (requeued,))
+        return [(job_id, Drug(*json.loads(drug)), browser) for job_id, drug, browser in rows]
+
+
+    def renew(self, worker_id):
+        with self.lock:
+            try:
+                self.db.execute("UPDATE jobs SET lease_until = ? WHERE state = 'leased' "\
+                    "AND worker = ?", (time.time() + self.lease, worker_id))
+            except sqlite3.OperationalError as e:
+                # Renewed again a third of a lease later
+                log.error("Couldn't renew leases in %s: %s" % (self.path, e))
+
+
+    def add(self, job_id, drug, user_agent, coupons, failed=False):
+        """A lookup that gave up with some coupons is kept as partial"""
+        state = ("partial" if failed else "done") if coupons else "failed"
+        with self.lock:
+            self.db.execute("UPDATE jobs SET state = ?, user_agent = ?, coupons = ? "\
+                "WHERE job_id = ?", (state, user_agent.user_agent,
+                json.dumps([list(coupon) for coupon in coupons or []]), job_id))
+
+
+    def counts(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT state, COUNT(*) FROM jobs "\
+                                        "GROUP BY state").fetchall())
+
+
+    def unfinished(self, browsers):
+        """Jobs for browsers that are waiting or leased anywhere"""
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE state IN "\
+                "('pending', 'leased') AND browser IN (%s)" % (", ".join("?" * len(browsers)),),
+                list(browsers)).fetchone()[0]
+
+
+    def finished(self):
+        """Yields (Drug, browser, user_agent, coupons, failed) for each done
+        or partial job in input order"""
+        cursor = self.db.execute("SELECT drug, browser, user_agent, coupons, state FROM jobs "\
+                                 "WHERE state IN ('done', 'partial') ORDER BY job_id")
+        for drug, browser, user_agent, coupons, state in cursor:
+            yield (Drug(*json.loads(drug)), browser, user_agent,
+                   [Coupon(*coupon) for coupon in json.loads(coupons)], state == "partial")
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+# Python 2 has no os.replace, its os.rename replaces on POSIX
+replaceFile = getattr(os, "replace", os.rename)
+
+
+class UserAgentStore():
+    """JSON file of the last User-Agent seen for each browser, so startup
+    doesn't need the network when the stored ones are recent enough"""
+    def __init__(self, path):
+        self.path = path
+        self.fetched = 0
+
+
+    def load(self):
+        try:
+            with open(self.path) as infile:
+                stored = json.load(infile)
+            self.fetched = stored["fetched"]
+            return stored["agents"]
+        except Exception as e:
+            if os.path.exists(self.path):
+                log.error(traceback.format_exc())
+                log.error("Unable to read User-Agent store %s" % (self.path,))
+            return {}
+
+
+    def age(self):
+        return time.time() - self.fetched
+
+
+    def save(self, agents):
+        """Writes a temporary file and moves it into place, so a refresh
+        killed at exit never leaves half a store"""
+        temporary = "%s.%s.tmp" % (self.path, os.getpid())
+        try:
+            with open(temporary, "w") as outfile:
+                json.dump({"fetched": time.time(), "agents": agents}, outfile, indent=2)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            replaceFile(temporary, self.path)
+        except Exception as e:
+            log.error(traceback.format_exc())
+            log.error("Unable to save User-Agent store %s" % (self.path,))
+
+
 class Driver():
     def __init__(self):
         self.findChromedriver()
@@ -158,234 +1759,791 @@ class Driver():
         log.info("Chromedriver found")
 
 
-    def safariUserAgentHelper(self):
-        UserAgent = namedtuple("UserAgent", ["browser", "user_agent"])
-        user_agent = None
+    def safariUserAgentHelper(self, timeout):
+        """Returns a Safari User-Agent string from useragentstring.com, or None"""
         url = "http://useragentstring.com/pages/useragentstring.php?name=Safari"
         try:
-            response = requests.get(url, timeout=wait)
+            response = requests.get(url, timeout=timeout)
             response_text = response.text
             bsobject = bs(response_text, "html.parser")
             links = bsobject.find_all("a")
             specific_safari_version = "iPhone OS 4_1"
             for link in links:
                 if specific_safari_version in link.text:
-                    user_agent = UserAgent("Safari", link.text)
-                    log.info("Safari User-Agent loaded")
-                    break
+                    return link.text
         except Exception as e:
             log.error(traceback.format_exc())
-            log.info("Can't pull Safari User-Agent from useragentstring.com.  Using default Safari User-Agent")
-            user_agent_string = "Mozilla/5.0 (iPhone; CPU iPhone OS 5_1_1 like "\
-                "Mac OS X) AppleWebKit/534.46 (KHTML, like Gecko) Version/5.1 "\
-                "Mobile/9B206 Safari/7534.48.3"
-            user_agent = UserAgent("Safari", user_agent_string)
-        return user_agent
-
-    def setupUserAgents(self):
-        user_agents = []
-        UserAgent = namedtuple("UserAgent", ["browser", "user_agent"])
-
-        try:
-            args = sys.argv[2]
-        except:
-            logging.error("Browsers like Chrome, Internet Explorer, and/or "\
-                "Safari need to be in the 2nd position command line arguments")
-            sys.exit()
+            log.info("Can't pull Safari User-Agent from useragentstring.com")
+        return None
 
-        if "Safari" in args:
-            safari_user_agent = self.safariUserAgentHelper()
-            if safari_user_agent:
-                user_agents.append(safari_user_agent)
 
-        if ("Internet Explorer" in args) or ("Chrome" in args):
-            ua = None
-            try:
-                ua = UA()
-            except:
-                log.error("Unable to load fakeuseragent package for Chrome and Internet Explorer User-Agents")
-            try:
-                if ua:
+    def fetchUserAgents(self, browsers, budget, store):
+        """Looks up fresh User-Agents in a background thread, which saves
+        them to store when it's done, and returns whatever was found once
+        the thread finishes or budget seconds pass"""
+        found = {}
+        def fetch():
+            if "Safari" in browsers:
+                safari = self.safariUserAgentHelper(min(wait, max(budget, 1)))
+                if safari:
+                    found["Safari"] = safari
+            if ("Internet Explorer" in browsers) or ("Chrome" in browsers):
+                try:
+                    from fake_useragent import UserAgent as UA
+                    ua = UA()
                     ua.update()
-            except:
-                log.error("Unable to update fakeuseragent package for Chrome and Internet Explorer User-Agents")
-            if not ua:
-                UA = namedtuple("UA", ["ie", "chrome"])
-                ua = UA("Mozilla/4.0 (compatible; MSIE 8.0; Windows NT 6.1; "\
-                    "WOW64; Trident/4.0; SLCC2; .NET CLR 2.0.50727; Media "\
-                    "Center PC 6.0; .NET CLR 3.5.30729; .NET CLR 3.0.30729; .NET4.0C)",
-                    "Mozilla/5.0 (X11; CrOS i686 4319.74.0) AppleWebKit/537.36 "\
-                    "(KHTML, like Gecko) Chrome/29.0.1547.57 Safari/537.36")
-                log.info("Using default User-Agents for Internet Explorer and/or Chrome")
-            if "Internet Explorer" in args:
-                user_agents.append(UserAgent("Internet Explorer", ua.ie))
-                log.info("Internet Explorer User-Agent loaded")
-            if "Chrome" in args:
-                user_agents.append(UserAgent("Chrome", ua.chrome))
-                log.info("Chrome User-Agent loaded")
-
-        if not user_agents:
+                    found["Internet Explorer"] = ua.ie
+                    found["Chrome"] = ua.chrome
+                except Exception as e:
+                    log.error(traceback.format_exc())
+                    log.error("Unable to load fakeuseragent package for Chrome and Internet Explorer User-Agents")
+            if found:
+                agents = store.load()
+                agents.update(found)
+                store.save(agents)
+        thread = threading.Thread(target=fetch, name="UserAgents")
+        thread.daemon = True
+        thread.start()
+        if budget:
+            thread.join(budget)
+            if thread.is_alive():
+                log.error("User-Agent lookup took longer than %ss, not waiting for it" % (budget,))
+        return dict(found)
+
+
+    def setupUserAgents(self):
+        start = time.time()
+        args = getArgument("browsers", "")
+        browsers = [browser for browser in ("Safari", "Internet Explorer", "Chrome")
+                    if browser in args]
+        if not browsers:
             logging.error("Browsers like Chrome, Internet Explorer, and/or "\
                 "Safari need to be in the 2nd position command line arguments")
             sys.exit()
+
+        store = UserAgentStore(getOption("ua-store", "goodrx-useragents.json"))
+        refresh_days = getOption("ua-refresh", 7)
+        budget = getOption("ua-budget", 3)
+        agents = store.load()
+        missing = [browser for browser in browsers if browser not in agents]
+        if hasOption("offline"):
+            log.info("Offline, not refreshing User-Agents")
+        elif missing:
+            agents.update(self.fetchUserAgents(browsers, budget, store))
+        elif store.age() > refresh_days * 86400:
+            # The stored ones still work, refresh them for the next run
+            # without holding this one up
+            self.fetchUserAgents(browsers, 0, store)
+
+        user_agents = []
+        for browser in browsers:
+            if browser in agents:
+                log.info("%s User-Agent loaded" % (browser,))
+            else:
+                log.info("Using default %s User-Agent" % (browser,))
+            user_agents.append(UserAgent(browser, agents.get(browser, DEFAULT_USER_AGENTS[browser])))
         self.user_agents = user_agents
+        log.info("User-Agents ready in %.2fs" % (time.time() - start,))
+
 
+    def blockedResources(self, browser):
+        """Kinds of resources to block for browser, from --block-<browser>
+        or else --block, e.g. images,fonts,trackers"""
+        setting = getOption("block-" + BROWSER_OPTIONS[browser], getOption("block", ""))
+        blocked = [kind.strip() for kind in setting.split(",") if kind.strip()]
+        for kind in blocked:
+            if kind not in BLOCKABLE:
+                log.error("Can't block %s, choose from %s" % (kind, ", ".join(BLOCKABLE)))
+        return [kind for kind in blocked if kind in BLOCKABLE]
 
-    def initWebsiteDriver(self, user_agent):
+
+    def browserOptions(self, blocked):
         opts = Options()
-        opts.add_argument("user-agent=%s" % (user_agent,))
+        if hasOption("headless"):
+            opts.add_argument("--headless")
+            opts.add_argument("--disable-gpu")
+        if "images" in blocked:
+            opts.add_experimental_option("prefs",
+                {"profile.managed_default_content_settings.images": 2})
+            opts.add_argument("--blink-settings=imagesEnabled=false")
+        if "media" in blocked:
+            opts.add_argument("--autoplay-policy=user-gesture-required")
+        return opts
 
+
+    def startChrome(self, opts, blocked):
         try:
             driver = webdriver.Chrome(executable_path=self.chromedriver_path,
-                                       chrome_options=opts)
-            driver.set_window_position(-2000,-2000)
+                                      chrome_options=opts)
+            if not hasOption("headless"):
+                driver.set_window_position(-2000,-2000)
         except Exception as e:
             log.error(traceback.format_exc())
             log.error("Can't initialize browser. Is the chromedriver in the same directory as the exe?")
-            sys.exit()
+            raise BrowserStartFailed(str(e))
+
+        patterns = []
+        for kind in blocked:
+            patterns.extend(BLOCKABLE[kind])
+        if patterns:
+            try:
+                driver.execute_cdp_cmd("Network.enable", {})
+                driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": patterns})
+            except Exception as e:
+                log.error(traceback.format_exc())
+                log.error("This chromedriver can't block requests, only images will be blocked")
         return driver
 
 
-    def initMobileDriver(self, user_agent):
+    def initWebsiteDriver(self, user_agent, browser="Chrome"):
+        blocked = self.blockedResources(browser)
+        opts = self.browserOptions(blocked)
+        opts.add_argument("user-agent=%s" % (user_agent,))
+        if hasOption("headless"):
+            # Headless Chrome defaults to 800x600, which gets the narrow layout
+            opts.add_argument("--window-size=1366,768")
+        return self.startChrome(opts, blocked)
+
+
+    def initMobileDriver(self, user_agent, browser="Safari"):
         mobile_emulation = {
             "deviceMetrics": { "width": 360, "height": 640, "pixelRatio": 3.0 },
             "userAgent": user_agent}
-        opts = Options()
+        blocked = self.blockedResources(browser)
+        opts = self.browserOptions(blocked)
         opts.add_experimental_option("mobileEmulation", mobile_emulation)
-        try:
-            driver = webdriver.Chrome(executable_path=self.chromedriver_path,
-                                      chrome_options=opts)
-            driver.set_window_position(-2000,-2000)
-        except Exception as e:
-            log.error(traceback.format_exc())
-            log.error("Can't initialize browser. Is the chromedriver in the same directory as the exe?")
-            sys.exit()
-        return driver
+        return self.startChrome(opts, blocked)
 
 
     def buildURL(self, drug, mobile=""):
         if mobile == True:
             mobile = 'm.'
-        return "http://www.{}goodrx.com/{}?drug-name={}&form={}&dosage={}&quantity="\
-            "{}&days_supply=&label_override={}".format(mobile, drug.drug_name, drug.drug_name,
+        site = replay_base or "http://www.{}goodrx.com".format(mobile)
+        return "{}/{}?drug-name={}&form={}&dosage={}&quantity="\
+            "{}&days_supply=&label_override={}".format(site, drug.drug_name, drug.drug_name,
                 drug.form, drug.dosage, drug.quantity, drug.label_override)
 
 
-    def setupDrivers(self, drug):
-        for user_agent in self.user_agents:
-            browser = user_agent.browser
-            user_agent = user_agent.user_agent
+    def setupDriver(self, drug, user_agent, pool):
+        session = pool.acquire(user_agent)
+        if session.browser == "Safari":
+            url = self.buildURL(drug=drug, mobile=True)
+        else:
+            url = self.buildURL(drug)
+        return session, url
+
+
+class Session():
+    """A live browser that is reused across drugs.  Remembers the location it
+    was last set to so the location modal is only filled in once per zip"""
+    def __init__(self, driver, browser, user_agent):
+        self.driver = driver
+        self.browser = browser
+        self.user_agent = user_agent
+        self.pages = 0
+        self.location = None
+
+
+    def isAlive(self):
+        try:
+            self.driver.current_url
+            return True
+        except Exception as e:
+            return False
+
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except Exception as e:
+            log.error(traceback.format_exc())
+            log.error("Unable to quit %s browser cleanly" % (self.browser,))
+
+
+class DriverPool():
+    """Keeps one browser session per UserAgent.browser alive for the whole run.
+    Sessions are restarted after max_pages lookups or when they stop responding"""
+    def __init__(self, driver_tool, max_pages=MAX_PAGES_PER_SESSION):
+        self.driver_tool = driver_tool
+        self.max_pages = max_pages
+        self.sessions = {}
+
+
+    def acquire(self, user_agent):
+        browser = user_agent.browser
+        session = self.sessions.get(browser)
+        if session and session.pages >= self.max_pages:
+            log.info("Recycling %s browser after %s pages" % (browser, session.pages))
+            self.discard(browser)
+            session = None
+        elif session and not session.isAlive():
+            log.error("%s browser stopped responding, restarting it" % (browser,))
+            self.discard(browser)
+            session = None
+
+        if not session:
+            start = time.time()
             if browser == "Safari":
-                driver = self.initMobileDriver(user_agent)
-                url = self.buildURL(drug=drug, mobile=True)
-                yield driver, user_agent, browser, url
+                driver = self.driver_tool.initMobileDriver(user_agent.user_agent, browser)
             else:
-                driver = self.initWebsiteDriver(user_agent)
-                url = self.buildURL(drug)
-                yield driver, user_agent, browser, url
+                driver = self.driver_tool.initWebsiteDriver(user_agent.user_agent, browser)
+            metrics.add(browser, "driver start", time.time() - start)
+            session = Session(driver, browser, user_agent.user_agent)
+            self.sessions[browser] = session
+        session.pages += 1
+        return session
+
+
+    def discard(self, browser):
+        session = self.sessions.pop(browser, None)
+        if session:
+            session.quit()
+
+
+    def closeAll(self):
+        for browser in list(self.sessions):
+            self.discard(browser)
+
+
+class HttpFetcher():
+    """Fetches and parses price pages with plain HTTP instead of a browser.
+    Location cookies are copied out of a browser session the first time each
+    browser/zip pair is seen and shared between workers.  Returns None from
+    fetch when the page needs a real browser"""
+    location_cookies = {}
+    cookie_lock = threading.Lock()
+
+    def __init__(self, driver_tool, pool):
+        self.driver_tool = driver_tool
+        self.pool = pool
+        self.sessions = {}
+
+
+    def httpSession(self, user_agent):
+        http = self.sessions.get(user_agent.browser)
+        if not http:
+            http = requests.Session()
+            http.headers["User-Agent"] = user_agent.user_agent
+            adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=2)
+            http.mount("http://", adapter)
+            http.mount("https://", adapter)
+            self.sessions[user_agent.browser] = http
+        return http
+
+
+    def locationCookies(self, drug, user_agent, url):
+        if replay_base:
+            return [goodrx_replay.locationCookie(drug.location)]
+        key = (user_agent.browser, drug.location)
+        with self.cookie_lock:
+            cookies = self.location_cookies.get(key)
+        if cookies is None:
+            session = self.pool.acquire(user_agent)
+            try:
+                setChromeLocation(session, drug, url)
+            except ScrapeFailed as e:
+                return None
+            cookies = session.driver.get_cookies()
+            with self.cookie_lock:
+                self.location_cookies[key] = cookies
+            log.info("Copied location cookies for %s from %s" % (drug.location, user_agent.browser))
+        else:
+            counters.increment("Location cookies reused")
+        return cookies
+
+
+    def fetch(self, drug, user_agent, url):
+        browser = user_agent.browser
+        start = time.time()
+        cookies = self.locationCookies(drug, user_agent, url)
+        metrics.add(browser, "location", time.time() - start)
+        if cookies is None:
+            return None
+        http = self.httpSession(user_agent)
+        for cookie in cookies:
+            http.cookies.set(cookie["name"], cookie["value"],
+                             domain=cookie.get("domain", ""), path=cookie.get("path", "/"))
+        try:
+            start = time.time()
+            try:
+                response = http.get(url, timeout=timeouts.timeout(browser, "http load", wait))
+            except requests.Timeout:
+                timeouts.observe(browser, "http load", time.time() - start, timed_out=True)
+                raise
+            response.raise_for_status()
+            timeouts.observe(browser, "http load", time.time() - start)
+            metrics.add(browser, "load", time.time() - start)
+            start = time.time()
+            coupons, more = parseChromePage(response.text)
+            metrics.add(browser, "parse", time.time() - start)
+        except Exception as e:
+            log.error(traceback.format_exc())
+            log.error("Plain HTTP fetch failed for %s, falling back to %s browser" % (drug, user_agent.browser))
+            return None
+        if not coupons or more:
+            log.info("Page for %s needs JavaScript, falling back to %s browser" % (drug, user_agent.browser))
+            return None
+        if recorder:
+            recorder.save(user_agent.browser, drug.location, url, 0, response.text)
+        log.info("\nLoaded coupons over HTTP as %s @ %s\n%s" % (user_agent.browser, url, drug))
+        return coupons
+
 
+    def close(self):
+        for http in self.sessions.values():
+            http.close()
 
-def Chrome(driver, drug, url):
+
+def setReplayLocation(session, drug):
+    """Replayed pages are picked by a cookie instead of the location modal"""
+    try:
+        session.driver.get(replay_base + "/")
+        session.driver.add_cookie(goodrx_replay.locationCookie(drug.location))
+        session.location = drug.location
+        counters.increment("Location set")
+        return True
+    except Exception as e:
+        log.error(traceback.format_exc())
+        message = "Couldn't set replay location for %s in browser %s" % (drug, session.browser)
+        log.error(message)
+        raise ScrapeFailed(failureKind(session, e), message)
+
+
+class BrowserStartFailed(Exception):
+    """A browser couldn't be started, which no retry will fix"""
+    pass
+
+
+class ScrapeFailed(Exception):
+    """A lookup that didn't get its prices.  kind is what failureKind made
+    of it and coupons holds whatever was collected before it failed"""
+    def __init__(self, kind, message, coupons=None):
+        Exception.__init__(self, message)
+        self.kind = kind
+        self.coupons = coupons or []
+
+
+def failureKind(session, error):
+    """Sorts why a lookup failed into driver crash, blocked, timeout,
+    selector missing or error.  error is None when the page just had no
+    prices on it"""
+    if session is not None:
+        if not session.isAlive():
+            return "driver crash"
+        try:
+            text = session.driver.execute_script(BLOCKED_SCRIPT).lower()
+            if any(marker in text for marker in BLOCKED_MARKERS):
+                return "blocked"
+        except Exception as e:
+            pass
+    if isinstance(error, selenium_errors.TimeoutException):
+        return "timeout"
+    if error is None or isinstance(error, (selenium_errors.NoSuchElementException,
+            selenium_errors.StaleElementReferenceException, AttributeError, IndexError)):
+        return "selector missing"
+    return "error"
+
+
+def recordPage(session, drug, url, state, page_source=None):
+    """Saves what session is showing as state of the page when recording"""
+    if recorder:
+        if page_source is None:
+            page_source = session.driver.page_source
+        recorder.save(session.browser, drug.location, url, state, page_source)
+
+
+def setChromeLocation(session, drug, url):
+    driver = session.driver
+    if session.location == drug.location:
+        counters.increment("Location already set in session")
+        return True
+    if replay_base:
+        return setReplayLocation(session, drug)
     try:
-        location_button = WebDriverWait(driver, wait).until(\
-            EC.presence_of_element_located((By.ID, "setLocationButton")))
+        driver.get(url)
+        shown = driver.find_elements_by_xpath("//*[contains(text(), 'Lowest prices near')]")
+        if shown and str(drug.location) in shown[0].text:
+            counters.increment("Location already shown on page")
+            session.location = drug.location
+            return True
+        location_button = waitFor(session, "location",
+            EC.element_to_be_clickable((By.ID, "setLocationButton")))
         location_button.click()
 
-        location_modal = WebDriverWait(driver, wait).until(\
+        location_modal = waitFor(session, "location",
             EC.presence_of_element_located((By.ID, "locationDetection")))
         modal = driver.switch_to_active_element()
         location_input = modal.find_element_by_id("manualLocationQuery")
         location_input.send_keys(str(drug.location)+"\n")
 
-        location_loaded = WebDriverWait(driver, wait).until(\
+        location_loaded = waitFor(session, "location",
             EC.presence_of_element_located((\
             By.XPATH, "//*[contains(text(), 'Lowest prices near')]")))
+        session.location = drug.location
+        counters.increment("Location set")
+        return True
     except Exception as e:
         log.error(traceback.format_exc())
-        log.error("Couldn't load location for %s in browser %s" % (drug, "Chrome"))
-        return []
+        message = "Couldn't load location for %s in browser %s" % (drug, "Chrome")
+        log.error(message)
+        raise ScrapeFailed(failureKind(session, e), message)
 
-    view_more_pharmacies = True
+
+class CouponCollector():
+    """Insertion ordered set of coupons, so checking for a repeat costs the
+    same however many pharmacies have been loaded"""
+    def __init__(self):
+        self.coupons = []
+        self.seen = set()
+
+
+    def add(self, coupon):
+        """Returns True if the coupon wasn't collected yet"""
+        if coupon in self.seen:
+            return False
+        self.seen.add(coupon)
+        self.coupons.append(coupon)
+        return True
+
+
+    def __len__(self):
+        return len(self.coupons)
+
+
+    def __iter__(self):
+        return iter(self.coupons)
+
+
+    def __repr__(self):
+        return repr(self.coupons)
+
+
+def chromeCoupon(store_name, button_text, price_texts):
+    price = ""
+    for price_possible in price_texts:
+        if is_number(price_possible):
+            price = price_possible
+        if price_possible == "Free":
+            price = 0
+    return Coupon(price, store_name, processButton(button_text))
+
+
+# Elements whose insides are text even if they look like tags
+RAW_TEXT_TAGS = "script|style|textarea|title|xmp|noembed|noframes"
+# Tags, plus comments and raw text elements whose insides aren't tags, for
+# cutting the price rows out of a page without parsing it
+TAG_RE = re.compile(r"<!--.*?-->|<(%s)\b.*?</\1\s*>|<(/?)([a-zA-Z][\w:-]*)[^>]*>"
+                    % (RAW_TEXT_TAGS,), re.S | re.I)
+VOID_TAGS = set(["area", "base", "br", "col", "embed", "hr", "img", "input", "link",
+                 "meta", "param", "source", "track", "wbr"])
+# Tags whose end can be left out, so they can't be matched up by counting
+IMPLIED_END_TAGS = set(["p", "li", "dt", "dd", "tr", "td", "th", "option", "thead",
+                        "tbody", "tfoot", "colgroup", "caption"])
+LOCATION_RE = re.compile(r"""<div\b[^>]*\bid\s*=\s*["']locationDetection["']""", re.I)
+CLASS_ATTRIBUTE_RE = re.compile(r"""\sclass\s*=\s*["'][^"'<>]*$""", re.I)
+
+def containerStart(page_source, end):
+    """Where the element enclosing position end opens, walking back over
+    its earlier children a window at a time, or None"""
+    window = 4096
+    while True:
+        begin = max(0, end - window)
+        depth = 0
+        for match in reversed(list(TAG_RE.finditer(page_source, begin, end))):
+            closing, name = match.group(2), match.group(3)
+            if not name or match.group(0).endswith("/>") or name.lower() in VOID_TAGS:
+                continue
+            if closing:
+                depth += 1
+            elif depth:
+                depth -= 1
+            else:
+                return match.start(), name.lower()
+        if begin == 0:
+            return None
+        window *= 4
+
+
+def locationContainer(page_source):
+    """The HTML of the element holding locationDetection, found by scanning
+    tags rather than parsing, so the parsers only build the price rows and
+    not the rest of the page.  The whole page if it can't be cut cleanly"""
+    marker = LOCATION_RE.search(page_source)
+    found = marker and containerStart(page_source, marker.start())
+    if not found or found[1] in IMPLIED_END_TAGS:
+        return page_source
+    start, name = found
+    depth = 0
+    tags = re.compile(r"<!--.*?-->|<(%s)\b.*?</\1\s*>|<(/?)%s[\s>]"
+                      % (RAW_TEXT_TAGS, re.escape(name)), re.S | re.I)
+    for match in tags.finditer(page_source, start):
+        if match.group(1) or match.group(2) is None:
+            continue
+        depth += -1 if match.group(2) else 1
+        if depth == 0:
+            return page_source[start:page_source.find(">", match.end() - 1) + 1]
+    return page_source
+
+
+def findLocation(page_source, parse, find):
+    """find's result on the parsed locationDetection container, or on the
+    whole page when what was cut out doesn't hold locationDetection"""
+    fragment = locationContainer(page_source)
+    found = find(parse(fragment))
+    if found is None and fragment is not page_source:
+        found = find(parse(page_source))
+    return found
+
+
+def hasViewButton(page_source):
+    """Whether an element has the view-button class, without parsing"""
+    position = page_source.find("view-button")
+    while position >= 0:
+        after = page_source[position + len("view-button"):position + len("view-button") + 1]
+        if not re.match(r"[\w-]", page_source[position - 1]) and not re.match(r"[\w-]", after) \
+                and CLASS_ATTRIBUTE_RE.search(page_source, page_source.rfind("<", 0, position), position):
+            return True
+        position = page_source.find("view-button", position + 1)
+    return False
+
+
+def parseChromePageSoup(page_source, start=0):
+    coupons = []
+    container = findLocation(page_source, lambda html: bs(html, 'html.parser'),
+                             lambda page: page.find("div", id="locationDetection")).parent
+    rows = container.find_all("div", class_="price-row")
+    for row in rows[start:]:
+        prices = row.find_all("span", class_="font-weight-medium")
+        coupons.append(chromeCoupon(row.find("div", class_="store-name").text,
+                                    row.find("button").text,
+                                    [price.text for price in prices]))
+    return coupons, hasViewButton(page_source)
+
+
+def hasClass(name):
+    return "contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % (name,)
+
+
+def parseChromePageLxml(page_source, start=0):
     coupons = []
-    Coupon = namedtuple("Coupon", ["price", "store_name", "method"])
+    container = findLocation(page_source, lxml_html.fromstring,
+        lambda page: (page.xpath('//div[@id="locationDetection"]') or [None])[0]).getparent()
+    rows = container.xpath('.//div[%s]' % (hasClass("price-row"),))
+    for row in rows[start:]:
+        prices = row.xpath('.//span[%s]' % (hasClass("font-weight-medium"),))
+        coupons.append(chromeCoupon(
+            row.xpath('.//div[%s]' % (hasClass("store-name"),))[0].text_content(),
+            row.xpath('.//button')[0].text_content(),
+            [price.text_content() for price in prices]))
+    return coupons, hasViewButton(page_source)
+
+
+def parseChromePageSelectolax(page_source, start=0):
+    coupons = []
+    container = findLocation(page_source, SelectolaxParser,
+                             lambda page: page.css_first("div#locationDetection")).parent
+    rows = container.css("div.price-row")
+    for row in rows[start:]:
+        prices = row.css("span.font-weight-medium")
+        coupons.append(chromeCoupon(row.css_first("div.store-name").text(),
+                                    row.css_first("button").text(),
+                                    [price.text() for price in prices]))
+    return coupons, hasViewButton(page_source)
+
+
+# Fastest first.  All of them only look for rows inside the
+# locationDetection container and return the same coupons
+CHROME_PARSERS = OrderedDict([
+    ("selectolax", parseChromePageSelectolax),
+    ("lxml", parseChromePageLxml),
+    ("html.parser", parseChromePageSoup)])
+chrome_parser = parseChromePageSoup
+parser_choice = "auto"
+parser_lock = threading.Lock()
+
+
+def availableParsers():
+    available = ["html.parser"]
+    if lxml_html.installed():
+        available.insert(0, "lxml")
+    if SelectolaxParser.installed():
+        available.insert(0, "selectolax")
+    return available
+
+
+def pickParser():
+    global chrome_parser
+    with parser_lock:
+        if chrome_parser is None:
+            available = availableParsers()
+            parser = parser_choice
+            if parser == "auto":
+                parser = available[0]
+            elif parser not in available:
+                log.error("--parser %s isn't available, choose from %s"
+                          % (parser, ", ".join(available)))
+                parser = available[0]
+            log.info("Parsing Chrome pages with %s" % (parser,))
+            chrome_parser = CHROME_PARSERS[parser]
+    return chrome_parser
+
+
+def parseChromePage(page_source, start=0):
+    """Returns a coupon for each price row on a desktop price page from row
+    start on, in page order, and whether the page has a button for loading
+    more pharmacies"""
+    return (chrome_parser or pickParser())(page_source, start)
+
+
+def Chrome(session, drug, url):
+    driver = session.driver
+    start = time.time()
+    try:
+        setChromeLocation(session, drug, url)
+    finally:
+        metrics.add(session.browser, "location", time.time() - start)
+
+    view_more_pharmacies = True
+    coupons = CouponCollector()
+    rows_seen = 0
+    state = 0
+    start = time.time()
     driver.get(url)
-    time.sleep(wait)
+    waitFor(session, "load", EC.presence_of_element_located((By.CLASS_NAME, "price-row")),
+            required=False)
+    waitFor(session, "settle", domStable(), required=False)
+    metrics.add(session.browser, "load", time.time() - start)
     try:
         while view_more_pharmacies:
             view_more_pharmacies = False
             if coupons:
+                start = time.time()
+                row_count = len(driver.find_elements_by_css_selector("div.price-row"))
                 driver.find_element_by_class_name("view-button").click()
-                time.sleep(wait)
-            page = bs(driver.page_source, 'html.parser')
-            container = page.find("div", id="locationDetection").parent
-            rows = container.find_all("div", class_="price-row")
-            for row in rows:
-                store_name = row.find("div", class_="store-name").text
-                method = processButton(row.find("button").text)
-
-                price = ""
-                prices = row.find_all("span", class_="font-weight-medium")
-                for price_possible in prices:
-                    if is_number(price_possible.text):
-                        price = price_possible.text
-                    if price_possible.text == "Free":
-                        price = 0
-
-                possible_coupon = Coupon(price, store_name, method)
-                if possible_coupon not in coupons:
-                    coupons.append(possible_coupon)
+                waitFor(session, "rows", rowsIncreased("div.price-row", row_count,
+                        ".view-button"), required=False)
+                metrics.add(session.browser, "click", time.time() - start)
+            start = time.time()
+            page_source = driver.page_source
+            recordPage(session, drug, url, state, page_source)
+            state += 1
+            # Loading more pharmacies appends rows, so only the new ones are parsed
+            page_coupons, more = parseChromePage(page_source, rows_seen)
+            rows_seen += len(page_coupons)
+            for possible_coupon in page_coupons:
+                if coupons.add(possible_coupon):
                     view_more_pharmacies = True
+            # Every pharmacy is showing once the button is gone
+            if not more:
+                view_more_pharmacies = False
+            metrics.add(session.browser, "parse", time.time() - start)
     except Exception as e:
         log.error(traceback.format_exc())
         log.error("Main parsing logic broken for Chrome:\n%s\n%s" % (drug, coupons,))
-    return coupons
+        raise ScrapeFailed(failureKind(session, e), "Main parsing logic broken for Chrome",
+                           list(coupons))
+    return list(coupons)
 
-def checkForModalInIE(driver):
-    modal = driver.find_elements_by_xpath("//div[contains(@class,"\
+def extractRows(driver, container_css, row_css, field_css, start, more_css=None):
+    """Returns how many rows match row_css inside container_css, for each
+    row from start on the text of the first match of each field_css or None,
+    and whether anything on the page matches more_css"""
+    page = driver.execute_script(ROWS_SCRIPT, container_css, row_css, field_css, start,
+                                 more_css)
+    if page is None:
+        raise selenium_errors.NoSuchElementException("Nothing on the page matches %s" % (container_css,))
+    return page["total"], page["rows"], page["more"]
+
+
+def checkForModalInIE(session):
+    modal = session.driver.find_elements_by_xpath("//div[contains(@class,"\
         "'modal-backdrop') and contains(@class, 'in')]")
     if modal:
-        dont_show_again = WebDriverWait(driver, wait).until(\
-            EC.presence_of_element_located((By.CLASS_NAME, "dont-show-again")))
-        time.sleep(wait)
+        dont_show_again = waitFor(session, "modal",
+            EC.element_to_be_clickable((By.CLASS_NAME, "dont-show-again")))
         dont_show_again.click()
 
 
-def InternetExplorer(driver, drug, url):
+def setInternetExplorerLocation(session, drug, url):
+    driver = session.driver
+    if session.location == drug.location:
+        counters.increment("Location already set in session")
+        return True
+    if replay_base:
+        return setReplayLocation(session, drug)
     try:
-        location_input = WebDriverWait(driver, wait).until(\
-            EC.presence_of_element_located((By.XPATH,
-            "//input[contains(@class, 'span9') and "\
-            "contains(@placeholder, 'Enter your ZIP code')]")))
+        driver.get(url)
+        input_xpath = "//input[contains(@class, 'span9') and "\
+            "contains(@placeholder, 'Enter your ZIP code')]"
+        location_input = waitFor(session, "location",
+            EC.presence_of_element_located((By.XPATH, input_xpath)))
+        if location_input.get_attribute("value") == str(drug.location):
+            counters.increment("Location already shown on page")
+            session.location = drug.location
+            return True
         location_input.send_keys(str(drug.location) + "\n")
-        time.sleep(wait*1.5)
+        reloaded = waitFor(session, "location", EC.staleness_of(location_input), required=False)
+        waitFor(session, "settle", domStable(), required=False)
+        # The page may never settle, so the location is taken once the page
+        # has reloaded or shows it
+        shown = driver.find_elements_by_xpath(input_xpath)
+        if not reloaded and not (shown and shown[0].get_attribute("value") == str(drug.location)):
+            raise selenium_errors.TimeoutException("Location %s wasn't taken" % (drug.location,))
+        session.location = drug.location
+        counters.increment("Location set")
+        return True
     except Exception as e:
         log.error(traceback.format_exc())
-        log.error("Couldn't load location for %s in browser %s" % (drug, "Internet Explorer"))
-        return []
+        message = "Couldn't load location for %s in browser %s" % (drug, "Internet Explorer")
+        log.error(message)
+        raise ScrapeFailed(failureKind(session, e), message)
+
+
+def InternetExplorer(session, drug, url):
+    driver = session.driver
+    start = time.time()
+    try:
+        setInternetExplorerLocation(session, drug, url)
+    finally:
+        metrics.add(session.browser, "location", time.time() - start)
 
+    start = time.time()
     driver.get(url)
-    time.sleep(wait)
+    waitFor(session, "load", EC.presence_of_element_located(
+            (By.CLASS_NAME, "drug-prices-result")), required=False)
+    waitFor(session, "settle", domStable(), required=False)
+    metrics.add(session.browser, "load", time.time() - start)
     view_more_pharmacies = True
-    coupons = []
-    Coupon = namedtuple("Coupon", ["price", "store_name", "method"])
+    coupons = CouponCollector()
+    rows_seen = 0
+    state = 0
 
     try:
         while view_more_pharmacies:
-            checkForModalInIE(driver)
+            checkForModalInIE(session)
             view_more_pharmacies = False
             if coupons:
-                load_more = WebDriverWait(driver, wait).until(\
-                    EC.presence_of_element_located((By.ID, "load-more-pharmacies")))
+                start = time.time()
+                load_more = waitFor(session, "click",
+                    EC.element_to_be_clickable((By.ID, "load-more-pharmacies")))
                 load_more.click()
-                time.sleep(wait*2.5)
-                checkForModalInIE(driver)
-
-            row_region = driver.find_element_by_class_name("price-group-expanded")
-            rows = row_region.find_elements_by_class_name("drug-prices-result")
-            for row in rows:
-                store_name = row.find_element_by_class_name("result-title").text
-                method = processButton(row.find_element_by_class_name("span3").text)
-                possible_price = row.find_element_by_class_name("price").text
+                waitFor(session, "rows", rowsIncreased(
+                    ".price-group-expanded .drug-prices-result", rows_seen,
+                    "#load-more-pharmacies"), default=wait*2.5, required=False)
+                checkForModalInIE(session)
+                metrics.add(session.browser, "click", time.time() - start)
+
+            start = time.time()
+            recordPage(session, drug, url, state)
+            state += 1
+            rows_seen, rows, more = extractRows(driver, ".price-group-expanded",
+                ".drug-prices-result", [".result-title", ".span3", ".price"], rows_seen,
+                "#load-more-pharmacies")
+            for store_name, method_text, possible_price in rows:
+                if None in (store_name, method_text, possible_price):
+                    raise selenium_errors.NoSuchElementException("Price row is missing a field: %s"
+                                                 % ([store_name, method_text, possible_price],))
+                method = processButton(method_text)
                 if not is_number(possible_price):
                     if possible_price == "FREE":
                         price = 0
@@ -395,102 +2553,796 @@ def InternetExplorer(driver, drug, url):
                     price = possible_price
 
                 possible_coupon = Coupon(price, store_name, method)
-                if possible_coupon not in coupons:
-                    coupons.append(possible_coupon)
+                if coupons.add(possible_coupon):
                     view_more_pharmacies = True
+            if not more:
+                view_more_pharmacies = False
+            metrics.add(session.browser, "parse", time.time() - start)
     except Exception as e:
         log.error(traceback.format_exc())
         log.error("Main parsing logic broken for Internet Explorer:\n%s\n%s" % (drug, coupons,))
-    return coupons
+        raise ScrapeFailed(failureKind(session, e),
+                           "Main parsing logic broken for Internet Explorer", list(coupons))
+    return list(coupons)
 
 
-def Safari(driver, drug, url):
+def setSafariLocation(session, drug, url):
+    driver = session.driver
+    if session.location == drug.location:
+        counters.increment("Location already set in session")
+        return True
+    if replay_base:
+        return setReplayLocation(session, drug)
     try:
-        location_button = WebDriverWait(driver, wait).\
-            until(EC.presence_of_element_located(\
+        driver.get(url)
+        location_button = waitFor(session, "location",
+            EC.element_to_be_clickable(\
             (By.XPATH,"//div[contains(@class, '-clickable') and "\
                       "contains(.//text(),'Add your location')]")))
         location_button.click()
 
-        location_modal = WebDriverWait(driver, wait).\
-            until(EC.presence_of_element_located(\
+        location_modal = waitFor(session, "location",
+            EC.presence_of_element_located(\
             (By.XPATH, "//div[contains(@class, 'floatfix') and "\
                        "contains(@class ,'scroll-overflow')]")))
         location_input = location_modal.find_element_by_tag_name("input")
         location_input.send_keys(str(drug.location) + "\n")
-        time.sleep(wait)
-        location_loaded = WebDriverWait(driver, wait).\
-            until(EC.presence_of_element_located(\
+        location_loaded = waitFor(session, "location",
+            EC.presence_of_element_located(\
             (By.XPATH, "//body[contains(@class, 'no-overflow')]")))
+        session.location = drug.location
+        counters.increment("Location set")
+        return True
     except Exception as e:
         log.error(traceback.format_exc())
-        log.error("Couldn't load location for %s in browser %s" % (drug, "Safari",))
-        return []
+        message = "Couldn't load location for %s in browser %s" % (drug, "Safari")
+        log.error(message)
+        raise ScrapeFailed(failureKind(session, e), message)
+
+
+def Safari(session, drug, url):
+    driver = session.driver
+    start = time.time()
+    try:
+        setSafariLocation(session, drug, url)
+    finally:
+        metrics.add(session.browser, "location", time.time() - start)
 
     view_more_pharmacies = True
-    coupons = []
-    Coupon = namedtuple("Coupon", ["price", "store_name", "method"])
+    coupons = CouponCollector()
+    rows_seen = 0
+    state = 0
+    start = time.time()
     driver.get(url)
-    time.sleep(wait)
+    waitFor(session, "settle", domStable(), required=False)
+    metrics.add(session.browser, "load", time.time() - start)
     try:
         while view_more_pharmacies:
             view_more_pharmacies = False
             if coupons:
+                start = time.time()
                 drug_list = driver.find_element_by_class_name("drug-price-list")
                 other_pharmacies = drug_list.find_element_by_class_name("more-pharmacies-bar")
                 other_pharmacies.click()
-                time.sleep(wait)
+                waitFor(session, "rows", rowsIncreased(".drug-price-list .list-item",
+                        rows_seen, ".drug-price-list .more-pharmacies-bar"),
+                        required=False)
+                metrics.add(session.browser, "click", time.time() - start)
 
-            drug_list = WebDriverWait(driver, wait).until(\
+            start = time.time()
+            drug_list = waitFor(session, "load",
                 EC.presence_of_element_located(\
                 (By.CLASS_NAME, "drug-price-list")))
-            rows = drug_list.find_elements_by_class_name("list-item")
-            for row in rows:
-                store_name = row.find_element_by_class_name("pharmacy-name").text
-                raw_method = row.find_element_by_class_name("drug-price-qualifier").text
+            recordPage(session, drug, url, state)
+            state += 1
+            rows_seen, rows, more = extractRows(driver, ".drug-price-list", ".list-item",
+                [".pharmacy-name", ".drug-price-qualifier", ".price-without-dollar",
+                 ".price-free"], rows_seen, ".drug-price-list .more-pharmacies-bar")
+            for store_name, raw_method, price_check, price_free in rows:
+                if store_name is None or raw_method is None:
+                    raise selenium_errors.NoSuchElementException("Price row is missing a field: %s"
+                                                 % ([store_name, raw_method],))
                 method = processButton(raw_method)
 
                 price = None
-                price_check = row.find_elements_by_class_name("price-without-dollar")
-                if price_check:
-                    price = price_check[0].text
+                if price_check is not None:
+                    price = price_check
                     if not is_number(price):
                         price = 0
-                else:
-                    price_free = row.find_elements_by_class_name("price-free")
-                    if price_free:
-                        if price_free[0].text == "Free":
-                            price = 0
+                elif price_free == "Free":
+                    price = 0
                 if price == None:
                     price = "Could not find price"
 
                 possible_coupon = Coupon(price, store_name, method)
-                if possible_coupon not in coupons:
-                    coupons.append(possible_coupon)
+                if coupons.add(possible_coupon):
                     view_more_pharmacies = True
+            if not more:
+                view_more_pharmacies = False
+            metrics.add(session.browser, "parse", time.time() - start)
     except Exception as e:
         log.error(traceback.format_exc())
         log.error("Main parsing logic broken for Safari:\n%s\n%s" % (drug, coupons,))
+        raise ScrapeFailed(failureKind(session, e), "Main parsing logic broken for Safari",
+                           list(coupons))
+    return list(coupons)
+
+
+def scrape(session, drug, url):
+    coupons = []
+    if session.browser == "Safari":
+        coupons = Safari(session, drug, url)
+    if session.browser == "Chrome":
+        coupons = Chrome(session, drug, url)
+    if session.browser == "Internet Explorer":
+        coupons = InternetExplorer(session, drug, url)
+    if not coupons:
+        raise ScrapeFailed(failureKind(session, None), "No prices on the page for %s in "\
+                           "browser %s" % (drug, session.browser))
+    page_stats.record(session)
+    log.info("\nLoaded coupons from browser %s @ %s\n%s" % (session.browser, url, drug))
     return coupons
 
 
+class RetryQueue():
+    """Failed lookups waiting for another try.  A lookup is tried up to
+    max_attempts times, waiting RETRY_BACKOFF seconds before the first retry
+    and twice as long before each one after.  Every attempt of every lookup
+    that failed at least once is kept for the report"""
+    def __init__(self, max_attempts):
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.waiting = []
+        self.attempts = {}
+
+
+    def __len__(self):
+        return len(self.waiting)
+
+
+    def failures(self, job_id):
+        return len(self.attempts.get(job_id, (None, None, []))[2])
+
+
+    def retry(self, job, kind):
+        """Records a failed attempt and returns True if the job was queued
+        to be tried again"""
+        job_id, drug, user_agent = job
+        counters.increment("Failed attempts (%s)" % (kind,))
+        with self.lock:
+            drug, browser, outcomes = self.attempts.setdefault(job_id,
+                (drug, user_agent.browser, []))
+            outcomes.append(kind)
+            if len(outcomes) >= self.max_attempts:
+                return False
+            ready = time.time() + RETRY_BACKOFF * 2 ** (len(outcomes) - 1)
+            heapq.heappush(self.waiting, (ready, job_id, job))
+        log.info("Retrying %s in browser %s after %s, attempt %s of %s"
+                 % (drug, user_agent.browser, kind, len(outcomes) + 1, self.max_attempts))
+        return True
+
+
+    def succeeded(self, job_id):
+        with self.lock:
+            if job_id in self.attempts:
+                self.attempts[job_id][2].append("ok")
+
+
+    def ready(self):
+        """Takes the jobs whose backoff is over off the queue"""
+        jobs = []
+        with self.lock:
+            while self.waiting and self.waiting[0][0] <= time.time():
+                jobs.append(heapq.heappop(self.waiting)[2])
+        return jobs
+
+
+    def report(self):
+        recovered = [job_id for job_id, (drug, browser, outcomes) in self.attempts.items()
+                     if outcomes[-1] == "ok"]
+        if self.attempts:
+            log.info("%s lookups failed at least once, %s recovered on retry and %s gave up"
+                     % (len(self.attempts), len(recovered), len(self.attempts) - len(recovered)))
+        for job_id in sorted(self.attempts):
+            drug, browser, outcomes = self.attempts[job_id]
+            log.info("%s in %s: %s attempts, %s, %s"
+                     % (drug, browser, len(outcomes),
+                        " then ".join(outcomes), "recovered" if job_id in recovered else "gave up"))
+
+
+def lookup(job, pool, fetcher, results, driver_tool):
+    job_id, drug, user_agent = job
+    if retry_queue.failures(job_id):
+        # A retry starts over in a new browser
+        pool.discard(user_agent.browser)
+    coupons = None
+    failure = None
+    source = "http"
+    start = time.time()
+    metrics.begin()
+    try:
+        if engine == "http" and user_agent.browser in HTTP_BROWSERS:
+            coupons = fetcher.fetch(drug, user_agent, driver_tool.buildURL(drug))
+        if coupons is None:
+            source = "browser"
+            session, url = driver_tool.setupDriver(drug, user_agent, pool)
+            coupons = scrape(session, drug, url)
+    except ScrapeFailed as e:
+        failure = e
+    except BrowserStartFailed:
+        raise
+    except Exception as e:
+        log.error(traceback.format_exc())
+        log.error("Worker failed on %s in browser %s" % (drug, user_agent.browser))
+        failure = ScrapeFailed(failureKind(None, e), str(e))
+    wait_timer.addBusy(time.time() - start)
+    metrics.end(drug, user_agent.browser, source, time.time() - start)
+    if failure:
+        if retry_queue.retry(job, failure.kind):
+            return
+        # Out of attempts, write out whatever was collected
+        coupons = failure.coupons
+    else:
+        retry_queue.succeeded(job_id)
+        if cache:
+            cache.put(drug, user_agent.browser, coupons)
+    results.add(job_id, drug, user_agent, coupons, failure is not None)
+
+
+def abandon(job, results):
+    """Finishes job as failed without coupons, so it's left for --resume"""
+    try:
+        results.add(job[0], job[1], job[2], None, True)
+    except Exception as e:
+        log.error(traceback.format_exc())
+        log.error("Couldn't give up on %s in browser %s" % (job[1], job[2].browser))
+
+
+def worker(jobs, results, driver_tool):
+    """Pull (Drug, UserAgent) jobs until a None comes off the queue, using browsers
+    owned by this thread only.  Failed lookups go to retry_queue before the
+    job is marked done, so runWorkers knows to wait for them.  A worker that
+    can't start a browser, or hits anything lookup doesn't handle, finishes
+    the job it holds as failed, so the results behind it aren't held up,
+    then stops and leaves the rest of the jobs to the others"""
+    pool = DriverPool(driver_tool)
+    fetcher = HttpFetcher(driver_tool, pool)
+    try:
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            try:
+                lookup(job, pool, fetcher, results, driver_tool)
+            except BrowserStartFailed:
+                log.error("%s can't start a %s browser, stopping"
+                          % (threading.current_thread().name, job[2].browser))
+                abandon(job, results)
+                break
+            except BaseException as e:
+                log.error(traceback.format_exc())
+                log.error("%s stopped on %s in browser %s"
+                          % (threading.current_thread().name, job[1], job[2].browser))
+                abandon(job, results)
+                break
+            finally:
+                jobs.task_done()
+    finally:
+        fetcher.close()
+        pool.closeAll()
+
+
+def runAsyncEngine(pending, results, driver_tool):
+    """Fetches every lookup the async engine can handle into results and
+    returns the jobs that still need a browser"""
+    import goodrx_async
+    pool = DriverPool(driver_tool)
+    fetcher = HttpFetcher(driver_tool, pool)
+    lookups = []
+    remaining = []
+    try:
+        for job in pending:
+            job_id, drug, user_agent = job
+            if user_agent.browser not in HTTP_BROWSERS:
+                remaining.append(job)
+                continue
+            url = driver_tool.buildURL(drug)
+            cookies = fetcher.locationCookies(drug, user_agent, url)
+            if cookies is None:
+                remaining.append(job)
+                continue
+            lookups.append((job, url, cookies))
+    finally:
+        pool.closeAll()
+
+    async_engine = goodrx_async.AsyncEngine(parseChromePage, log,
+        concurrency=concurrency, rate=rate,
+        timeout=timeouts.timeout("Chrome", "async fetch", wait))
+    start = time.time()
+    fetched = async_engine.run([(n, url, job[2].user_agent, cookies)
+                                for n, (job, url, cookies) in enumerate(lookups)])
+    wait_timer.addBusy(time.time() - start)
+    for n, (job, url, cookies) in enumerate(lookups):
+        job_id, drug, user_agent = job
+        if fetched.get(n) is None:
+            remaining.append(job)
+        else:
+            timeouts.observe(user_agent.browser, "async fetch", async_engine.latencies[n])
+            metrics.begin()
+            metrics.add(user_agent.browser, "async fetch", async_engine.latencies[n])
+            metrics.end(drug, user_agent.browser, "async", async_engine.latencies[n])
+            if cache:
+                cache.put(drug, user_agent.browser, fetched[n])
+            results.add(job_id, drug, user_agent, fetched[n])
+    log.info("Async engine loaded %s of %s lookups, %s left for the browser"
+             % (len(pending) - len(remaining), len(pending), len(remaining)))
+    return remaining
+
+
+def useCache(pending, results):
+    """Fills results from the cache and returns the jobs that missed.  With
+    --cache-only the misses are dropped instead of scraped.  With --history
+    every job is due a fresh check, so none come from the cache"""
+    if history:
+        return pending
+    remaining = []
+    for job in pending:
+        job_id, drug, user_agent = job
+        coupons = cache.get(drug, user_agent.browser)
+        if coupons is not None:
+            results.add(job_id, drug, user_agent, coupons)
+        elif cache_only:
+            log.info("No cached prices for %s in browser %s, skipping" % (drug, user_agent.browser))
+            results.add(job_id, drug, user_agent, None)
+        else:
+            remaining.append(job)
+    if cache_only:
+        return []
+    return remaining
+
+
+def iterJobs(csv_tool, driver_tool):
+    """Yields (job_id, Drug, UserAgent) for every lookup that isn't already
+    done, or with --history isn't due yet, numbering them from 0 in input
+    order"""
+    job_id = 0
+    for drug in csv_tool.csvToDrug():
+        for user_agent in driver_tool.user_agents:
+            if csv_tool.isDone(drug, user_agent.browser):
+                continue
+            if history and not recheck_all and not history.due(drug, user_agent.browser):
+                continue
+            yield job_id, drug, user_agent
+            job_id += 1
+
+
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def planJobs(planner, jobs):
+    for job in jobs:
+        job = planner.plan(job)
+        if job:
+            yield job
+
+
+def groupByLocation(jobs, window):
+    """Reads window jobs ahead and hands them out sorted by location, so a
+    worker's browsers see each zip in one run instead of switching back and
+    forth.  OrderedResults puts the output back in input order"""
+    for batch in batches(jobs, window):
+        batch.sort(key=lambda job: job[1].location.lower())
+        for job in batch:
+            yield job
+
+
+def runWorkers(csv_tool, driver_tool):
+    output = OrderedResults(csv_tool)
+    results = LookupPlanner(output)
+    processJobs(iterJobs(csv_tool, driver_tool), results, driver_tool, location_window)
+    output.finish(results.job_count)
+    results.report()
+    retry_queue.report()
+    counters.report()
+    page_stats.report()
+    if cache:
+        log.info("Loaded %s of %s lookups from the cache" % (cache.hits, results.job_count))
+
+
+def startWorker(name, jobs, results, driver_tool):
+    thread = threading.Thread(target=worker, name=name, args=(jobs, results, driver_tool))
+    thread.start()
+    return thread
+
+
+def startWorkers(jobs, results, driver_tool):
+    return [startWorker("Worker-%s" % (n+1,), jobs, results, driver_tool)
+            for n in range(workers)]
+
+
+def putWhileAlive(jobs, job, threads):
+    """Puts job on the bounded queue, giving up and returning False once
+    none of the worker threads are left to take it"""
+    while True:
+        try:
+            jobs.put(job, timeout=1)
+            return True
+        except queue.Full:
+            if not any(thread.is_alive() for thread in threads):
+                return False
+
+
+def processJobs(pending, results, driver_tool, window):
+    """Feeds jobs to the workers while they are still being read.  The job
+    queue is bounded so memory use doesn't grow with the input.  Returns
+    once every job and its retries are done, False if the worker threads
+    all died first"""
+    jobs = queue.Queue(maxsize=workers * QUEUE_PER_WORKER)
+    threads = startWorkers(jobs, results, driver_tool)
+
+    batch_size = ASYNC_BATCH if engine == "async" else 1
+    alive = True
+    try:
+        planned = planJobs(results, pending)
+        for batch in batches(groupByLocation(planned, window), batch_size):
+            if cache:
+                batch = useCache(batch, results)
+            if engine == "async" and batch:
+                batch = runAsyncEngine(batch, results, driver_tool)
+            for job in batch:
+                alive = all(putWhileAlive(jobs, job, threads)
+                            for job in [job] + retry_queue.ready())
+                if not alive:
+                    break
+            if not alive:
+                break
+        # Every job has been handed out, keep feeding retries until the
+        # workers are idle and none are left
+        while alive and (jobs.unfinished_tasks or len(retry_queue)):
+            for retry in retry_queue.ready():
+                putWhileAlive(jobs, retry, threads)
+            time.sleep(0.5)
+            alive = any(thread.is_alive() for thread in threads)
+        alive = any(thread.is_alive() for thread in threads)
+    finally:
+        for thread in threads:
+            if not putWhileAlive(jobs, None, threads):
+                break
+        for thread in threads:
+            thread.join()
+    if not alive:
+        log.error("Every worker stopped before the jobs were done")
+    return alive
+
+
+def claimJobs(store, worker_id, user_agents, count):
+    """Yields jobs claimed from store, count at a time, until there are no
+    pending ones left for these browsers"""
+    while True:
+        claimed = store.claim(worker_id, list(user_agents), count)
+        if not claimed:
+            return
+        for job_id, drug, browser in claimed:
+            yield job_id, drug, user_agents[browser]
+
+
+def runStoreWorker(store, driver_tool):
+    """--work: scrapes jobs from a shared store until none are left.  Once
+    nothing is pending it waits on jobs leased to other processes, in case
+    one dies and its jobs come back, and on the coordinator if it's still
+    queueing jobs"""
+    worker_id = "%s-%s" % (socket.gethostname(), os.getpid())
+    user_agents = dict((user_agent.browser, user_agent) for user_agent in driver_tool.user_agents)
+    stopped = threading.Event()
+    def heartbeat():
+        while not stopped.wait(store.lease / 3.0):
+            store.renew(worker_id)
+    thread = threading.Thread(target=heartbeat, name="Heartbeat")
+    thread.daemon = True
+    thread.start()
+    log.info("Working on %s as %s" % (store.path, worker_id))
+    try:
+        count = workers * QUEUE_PER_WORKER
+        while True:
+            if not processJobs(claimJobs(store, worker_id, user_agents, count),
+                               LookupPlanner(store), driver_tool, count):
+                log.error("Every worker died, leaving this process's jobs for others "\
+                          "once their leases run out")
+                break
+            queued = store.queued()
+            if queued and not store.unfinished(list(user_agents)):
+                break
+            log.info("Waiting on jobs leased to other workers" if queued else
+                     "Waiting on the coordinator to queue jobs")
+            time.sleep(STORE_POLL)
+    finally:
+        stopped.set()
+    retry_queue.report()
+    counters.report()
+    page_stats.report()
+
+
+def mergeJobStore(store, csv_tool):
+    """Writes every finished job in store to the csv in input order"""
+    merged = 0
+    for drug, browser, user_agent, coupons, failed in store.finished():
+        if csv_tool.isDone(drug, browser):
+            continue
+        for coupon in coupons:
+            csv_tool.putcsv(drug, coupon, browser, user_agent)
+        if not failed:
+            csv_tool.putChanges(drug, coupons, browser)
+        csv_tool.markDone(drug, browser)
+        merged += 1
+    log.info("Merged %s lookups from %s" % (merged, store.path))
+
+
+def coordinate(store, csv_tool, driver_tool):
+    """--coordinate: queues the input in store, waits while --work processes
+    get through it and merges the results into the csv"""
+    added = store.queue(iterJobs(csv_tool, driver_tool))
+    if added:
+        log.info("Queued %s lookups in %s" % (added, store.path))
+    else:
+        log.info("%s was already queued, carrying on with it" % (store.path,))
+    while True:
+        store.requeue()
+        counts = store.counts()
+        log.info("%s done, %s partial, %s failed, %s leased, %s pending" % (
+            counts.get("done", 0), counts.get("partial", 0), counts.get("failed", 0),
+            counts.get("leased", 0), counts.get("pending", 0)))
+        if not counts.get("leased") and not counts.get("pending"):
+            break
+        time.sleep(STORE_POLL)
+    mergeJobStore(store, csv_tool)
+
+
+class PriceRequest():
+    """Coupons for one --serve request, filled in as its lookups finish"""
+    def __init__(self, count):
+        self.count = count
+        self.coupons = {}
+        self.failed = set()
+        self.done = threading.Event()
+        if not count:
+            self.done.set()
+
+
+    def finish(self, job_id, coupons, failed):
+        self.coupons[job_id] = coupons
+        if failed:
+            self.failed.add(job_id)
+        if len(self.coupons) >= self.count:
+            self.done.set()
+
+
+class LookupService():
+    """Answers --serve requests with the worker threads, and so their
+    browsers and HTTP sessions, kept running in between.  Lookups from
+    requests that come in close together are batched, sorted by location
+    and collapsed before the workers get them.  Workers that stop, e.g. on
+    a browser that won't start, are replaced.  Takes add() calls from
+    LookupPlanner like OrderedResults"""
+    def __init__(self, driver_tool, max_pending):
+        self.driver_tool = driver_tool
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.in_flight = 0
+        self.next_id = 0
+        self.served = 0
+        self.turned_away = 0
+        self.restarts = 0
+        self.started = time.time()
+        self.stopped = threading.Event()
+        self.intake = queue.Queue()
+        # Prices aren't remembered between requests, the cache ttl decides
+        # how old an answer can be
+        self.results = LookupPlanner(self, remember=0)
+        self.jobs = queue.Queue(maxsize=workers * QUEUE_PER_WORKER)
+        self.threads = startWorkers(self.jobs, self.results, driver_tool)
+        self.dispatcher = threading.Thread(target=self.dispatch, name="Dispatcher")
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+
+    def browsers(self):
+        return [user_agent.browser for user_agent in self.driver_tool.user_agents]
+
+
+    def lookup(self, drugs, browsers, timeout):
+        """Returns (Drug, browser, coupons, failed) for every drug and browser
+        in order, coupons None where the lookup didn't finish within timeout
+        and failed True where it gave up.
+        Returns None without queueing anything when the lookups would put
+        more than max_pending in flight"""
+        user_agents = [user_agent for user_agent in self.driver_tool.user_agents
+                       if user_agent.browser in browsers]
+        jobs = []
+        with self.lock:
+            if self.in_flight + len(drugs) * len(user_agents) > self.max_pending:
+                self.turned_away += 1
+                return None
+            request = PriceRequest(len(drugs) * len(user_agents))
+            for drug in drugs:
+                for user_agent in user_agents:
+                    jobs.append((self.next_id, drug, user_agent))
+                    self.requests[self.next_id] = request
+                    self.next_id += 1
+            self.in_flight += len(jobs)
+        for job in jobs:
+            self.intake.put(job)
+        request.done.wait(timeout)
+        with self.lock:
+            # Lookups that timed out still finish and count as in flight
+            # until then, but nobody is waiting on them any more
+            for job_id, drug, user_agent in jobs:
+                self.requests.pop(job_id, None)
+            self.served += 1
+            return [(drug, user_agent.browser, request.coupons.get(job_id),
+                     job_id in request.failed) for job_id, drug, user_agent in jobs]
+
+
+    def add(self, job_id, drug, user_agent, coupons, failed=False):
+        with self.lock:
+            self.in_flight -= 1
+            request = self.requests.pop(job_id, None)
+            if request:
+                request.finish(job_id, coupons or [], failed)
+
+
+    def restartWorkers(self):
+        for n, thread in enumerate(self.threads):
+            if not thread.is_alive() and not self.stopped.is_set():
+                log.error("%s stopped, starting a new worker" % (thread.name,))
+                self.threads[n] = startWorker(thread.name, self.jobs, self.results,
+                                              self.driver_tool)
+                self.restarts += 1
+
+
+    def dispatch(self):
+        """Hands batches of requested lookups and due retries to the workers,
+        replacing any that stopped"""
+        while not self.stopped.is_set():
+            self.restartWorkers()
+            batch = []
+            try:
+                batch.append(self.intake.get(timeout=0.5))
+                deadline = time.time() + SERVICE_BATCH_WAIT
+                while len(batch) < ASYNC_BATCH:
+                    batch.append(self.intake.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty:
+                pass
+            try:
+                for retry in retry_queue.ready():
+                    if not putWhileAlive(self.jobs, retry, self.threads):
+                        self.results.add(retry[0], retry[1], retry[2], None)
+                batch.sort(key=lambda job: job[1].location.lower())
+                batch = list(planJobs(self.results, batch))
+                if cache and batch:
+                    batch = useCache(batch, self.results)
+                if engine == "async" and batch:
+                    batch = runAsyncEngine(batch, self.results, self.driver_tool)
+                for job in batch:
+                    if not putWhileAlive(self.jobs, job, self.threads):
+                        # Nobody is left to look it up
+                        self.results.add(job[0], job[1], job[2], None)
+            except Exception as e:
+                log.error(traceback.format_exc())
+                log.error("Dispatcher failed on a batch of %s lookups" % (len(batch),))
+                for job_id, drug, user_agent in batch:
+                    self.add(job_id, drug, user_agent, None)
+
+
+    def health(self):
+        alive = sum(1 for thread in self.threads if thread.is_alive())
+        with self.lock:
+            return {"status": "ok" if alive and self.dispatcher.is_alive() else "down",
+                    "workers": alive,
+                    "in_flight": self.in_flight,
+                    "max_pending": self.max_pending,
+                    "retrying": len(retry_queue),
+                    "served": self.served,
+                    "turned_away": self.turned_away,
+                    "worker_restarts": self.restarts,
+                    "engine": engine,
+                    "browsers": self.browsers(),
+                    "uptime": round(time.time() - self.started, 1)}
+
+
+    def close(self):
+        self.stopped.set()
+        self.dispatcher.join(1)
+        for thread in self.threads:
+            if not putWhileAlive(self.jobs, None, self.threads):
+                break
+        for thread in self.threads:
+            thread.join()
+
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def serve(driver_tool):
+    """--serve: answers price lookups over HTTP until interrupted or sent
+    SIGTERM, see goodrx_service.py"""
+    import goodrx_service
+    service = LookupService(driver_tool, service_max_pending)
+    try:
+        server = goodrx_service.PriceServer(service, Drug, log, service_port,
+                                            service_host, timeout=service_timeout)
+    except Exception as e:
+        log.error(traceback.format_exc())
+        log.error("Unable to listen on %s:%s" % (service_host, service_port))
+        service.close()
+        sys.exit()
+    signal.signal(signal.SIGTERM, interrupt)
+    log.info("Serving prices at http://%s:%s, up to %s lookups in flight"
+             % (service_host, server.server_address[1], service_max_pending))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Shutting down")
+    finally:
+        server.server_close()
+        service.close()
+    log.info("Answered %s requests and turned away %s" % (service.served, service.turned_away))
+    service.results.report()
+    retry_queue.report()
+    counters.report()
+    page_stats.report()
+
+
 if __name__ == "__main__":
+    parseArguments()
     setupLogger()
     setupWaitTime()
-    csv_tool = CSV()
-    driver_tool = Driver()
-    for drug in csv_tool.drugs:
-        for driver, user_agent, browser, url in driver_tool.setupDrivers(drug):
-            driver.get(url)
-            coupons = []
-            if browser == "Safari":
-                coupons = Safari(driver, drug, url)
-            if browser == "Chrome":
-                coupons = Chrome(driver, drug, url)
-            if browser == "Internet Explorer":
-                coupons = InternetExplorer(driver, drug, url)
-            log.info("\nLoaded coupons from browser %s @ %s\n%s" % (browser, url, drug))
-            for coupon in coupons:
-                csv_tool.putcsv(drug, coupon, browser, user_agent)
-            driver.close()
-    csv_tool.savecsv()
+    setupTimeouts()
+    setupRetries()
+    setupJobStore()
+    setupService()
+    setupWorkers()
+    setupEngine()
+    setupAsyncLimits()
+    setupReplay()
+    setupMetrics()
+    setupLocationWindow()
+    setupParser()
+    setupCache()
+    setupHistory()
+    if service_port is not None:
+        serve(Driver())
+    elif hasOption("work"):
+        runStoreWorker(job_store, Driver())
+    else:
+        csv_tool = CSV()
+        if hasOption("merge"):
+            mergeJobStore(job_store, csv_tool)
+        elif hasOption("coordinate"):
+            coordinate(job_store, csv_tool, Driver())
+        else:
+            runWorkers(csv_tool, Driver())
+        csv_tool.savecsv()
+    if job_store:
+        job_store.close()
+    if cache:
+        cache.close()
+    if history:
+        history.close()
+    metrics.close()
+    if recorder:
+        log.info("Recorded %s page states" % (recorder.pages,))
+    wait_timer.report()
+    timeouts.report()
+    metrics.report()
+    if getOption("metrics-out"):
+        metrics.save(getOption("metrics-out"))
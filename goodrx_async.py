@@ -0,0 +1,125 @@
+"""asyncio engine for goodrx.py, used with --engine async.
+
+Runs many price lookups at once over plain HTTP with aiohttp.  This module
+needs Python 3.7+ and aiohttp, so goodrx.py only imports it when the async
+engine is asked for.  It doesn't import goodrx itself; the page parser and
+logger are handed in so the results are the same Coupon tuples the browser
+scrapers return.
+"""
+import time
+import random
+import asyncio
+import traceback
+from urllib.parse import urlsplit
+
+import aiohttp
+
+# Responses worth retrying, everything else non-200 is given up on
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket():
+    """Allows rate requests per second on average with bursts up to burst"""
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncEngine():
+    """Fetches price pages with at most concurrency requests in flight and
+    at most rate requests per second to any one host.  Failed requests are
+    retried with jittered exponential backoff"""
+    def __init__(self, parse, log, concurrency=200, rate=10.0, burst=20,
+                 retries=3, backoff=0.5, timeout=5):
+        self.parse = parse
+        self.log = log
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.buckets = {}
+        self.latencies = {}
+
+
+    def bucket(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate, self.burst)
+        return self.buckets[host]
+
+
+    async def fetch(self, http, semaphore, url, user_agent, cookies):
+        """Returns the coupons on the page at url, or None when the page
+        couldn't be loaded or needs a real browser"""
+        # Sent as a header because aiohttp's cookie jar drops cookies for
+        # IP address hosts such as a local goodrx_replay.py server
+        headers = {"User-Agent": user_agent,
+                   "Cookie": "; ".join("%s=%s" % (cookie["name"], cookie["value"])
+                                       for cookie in cookies)}
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            await self.bucket(url).acquire()
+            try:
+                async with semaphore:
+                    async with http.get(url, headers=headers) as response:
+                        if response.status in RETRY_STATUSES:
+                            self.log.info("Got %s for %s, retrying" % (response.status, url))
+                            continue
+                        if response.status != 200:
+                            self.log.error("Got %s for %s" % (response.status, url))
+                            return None
+                        text = await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.log.info("Request for %s failed (%r), retrying" % (url, e))
+                continue
+
+            loop = asyncio.get_event_loop()
+            try:
+                coupons, more = await loop.run_in_executor(None, self.parse, text)
+            except Exception as e:
+                self.log.error(traceback.format_exc())
+                return None
+            if not coupons or more:
+                return None
+            return coupons
+        self.log.error("Gave up on %s after %s attempts" % (url, self.retries + 1))
+        return None
+
+
+    async def fetchAll(self, lookups):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as http:
+            async def one(lookup_id, url, user_agent, cookies):
+                start = time.monotonic()
+                coupons = await self.fetch(http, semaphore, url, user_agent, cookies)
+                self.latencies[lookup_id] = time.monotonic() - start
+                return lookup_id, coupons
+            done = await asyncio.gather(*[one(*lookup) for lookup in lookups])
+        return dict(done)
+
+
+    def run(self, lookups):
+        """lookups is a list of (lookup_id, url, user_agent, cookies).  Returns
+        a dict of lookup_id to a list of coupons, or None if it failed.
+        Seconds spent on each lookup end up in latencies"""
+        return asyncio.run(self.fetchAll(lookups))
@@ -0,0 +1,232 @@
+"""Record and replay price pages for goodrx.py, used with --record and --replay.
+
+With --record DIR every price page goodrx.py loads is saved to DIR as it
+looked before each "view more" click.  This module serves those pages back
+at the paths buildURL produces, so a run with --replay gets the recorded
+prices without going to goodrx.com:
+
+    python goodrx_replay.py DIR [--port 8765]
+    python goodrx.py input.csv Chrome 10 --replay http://127.0.0.1:8765
+
+A page is picked by the browser, told apart by User-Agent, the location,
+sent by goodrx.py in the LOCATION_COOKIE cookie, and the path and query of
+the URL.  Clicking "view more" on a replayed page loads the next recorded
+state.  Works on Python 2 and 3 and doesn't import goodrx.
+"""
+import os
+import re
+import sys
+import json
+import hashlib
+import threading
+try:
+    from urlparse import urlsplit
+    from urllib import quote, unquote
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from Cookie import SimpleCookie
+except ImportError:
+    from urllib.parse import urlsplit, quote, unquote
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from http.cookies import SimpleCookie
+
+LOCATION_COOKIE = "goodrx-replay-location"
+STATE_PARAMETER = "replay-state"
+# One JSON line per recorded lookup, for finding a page by hand
+INDEX = "index.jsonl"
+# Recorded pages are already rendered, running their scripts again would
+# change them and reach out to goodrx.com
+SCRIPT_RE = re.compile(r"<script\b.*?</script\s*>", re.I | re.S)
+STATE_RE = re.compile(r"[?&]%s=(\d+)" % (STATE_PARAMETER,))
+# The buttons that load more pharmacies in the Chrome, IE and Safari layouts
+MORE_BUTTONS = ".view-button, #load-more-pharmacies, .more-pharmacies-bar"
+NEXT_STATE_SCRIPT = """<script>
+document.addEventListener("click", function (event) {
+    if (event.target.closest && event.target.closest("%s")) {
+        event.preventDefault();
+        event.stopPropagation();
+        window.location.replace(%s);
+    }
+}, true);
+</script>"""
+
+
+def browserForUserAgent(user_agent):
+    if "iPhone" in user_agent or "iPad" in user_agent:
+        return "Safari"
+    if "MSIE" in user_agent or "Trident" in user_agent:
+        return "Internet Explorer"
+    return "Chrome"
+
+
+def pagePath(url):
+    """Path and query of url without the replay state, unquoted so it
+    compares equal however the client escaped it"""
+    parts = urlsplit(url)
+    query = [part for part in parts.query.split("&")
+             if not part.startswith(STATE_PARAMETER + "=")]
+    return unquote(parts.path) + "?" + unquote("&".join(query))
+
+
+def pageName(browser, location, path):
+    key = json.dumps([browser, str(location), path])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:20]
+
+
+def locationCookie(location):
+    return {"name": LOCATION_COOKIE, "value": quote(str(location), safe=""), "path": "/"}
+
+
+def getOption(name, default=None):
+    flag = "--" + name
+    if flag in sys.argv[:-1]:
+        return sys.argv[sys.argv.index(flag) + 1]
+    return default
+
+
+class Recorder():
+    """Saves page states to a fixture directory.  State 0 is the page as
+    first loaded and each "view more" click adds one"""
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.names = set(Fixtures(directory).states)
+        self.pages = 0
+
+
+    def save(self, browser, location, url, state, page_source):
+        path = pagePath(url)
+        name = pageName(browser, location, path)
+        if state == 0:
+            # A lookup recorded again may have fewer states than last time
+            for filename in os.listdir(self.directory):
+                if filename.startswith(name + "-"):
+                    os.remove(os.path.join(self.directory, filename))
+        page_source = SCRIPT_RE.sub("", page_source)
+        with open(os.path.join(self.directory, "%s-%s.html" % (name, state)), "wb") as outfile:
+            outfile.write(page_source.encode("utf-8"))
+        with self.lock:
+            self.pages += 1
+            if name in self.names:
+                return
+            self.names.add(name)
+            with open(os.path.join(self.directory, INDEX), "a") as index:
+                index.write(json.dumps({"name": name, "browser": browser,
+                    "location": str(location), "path": path}) + "\n")
+
+
+class Fixtures():
+    """The recorded pages in a fixture directory and how many states each
+    lookup has"""
+    def __init__(self, directory):
+        self.directory = directory
+        self.states = {}
+        for filename in os.listdir(directory):
+            match = re.match(r"^([0-9a-f]{20})-(\d+)\.html$", filename)
+            if match:
+                name, state = match.group(1), int(match.group(2))
+                self.states[name] = max(self.states.get(name, 0), state + 1)
+
+
+    def page(self, browser, location, url):
+        """Returns the requested state of a page with a script that loads
+        the next state on "view more", or None if it wasn't recorded"""
+        name = pageName(browser, location, pagePath(url))
+        if name not in self.states:
+            return None
+        match = STATE_RE.search(url)
+        last = self.states[name] - 1
+        state = min(int(match.group(1)) if match else 0, last)
+        with open(os.path.join(self.directory, "%s-%s.html" % (name, state)), "rb") as infile:
+            page_source = infile.read().decode("utf-8")
+
+        next_url = STATE_RE.sub("", url)
+        next_url += "%s%s=%s" % ("&" if "?" in next_url else "?",
+                                 STATE_PARAMETER, min(state + 1, last))
+        script = NEXT_STATE_SCRIPT % (MORE_BUTTONS, json.dumps(next_url))
+        end = page_source.lower().rfind("</body>")
+        if end < 0:
+            return page_source + script
+        return page_source[:end] + script + page_source[end:]
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if urlsplit(self.path).path == "/":
+            # goodrx.py loads this to set the location cookie on
+            return self.reply(200, "<html><body>goodrx replay</body></html>")
+        browser = browserForUserAgent(self.headers.get("User-Agent", ""))
+        cookies = SimpleCookie(self.headers.get("Cookie", ""))
+        location = ""
+        if LOCATION_COOKIE in cookies:
+            location = unquote(cookies[LOCATION_COOKIE].value)
+        page_source = self.server.fixtures.page(browser, location, self.path)
+        self.server.count(page_source is not None)
+        if page_source is None:
+            return self.reply(404, "No recorded %s page for %s at %s"
+                              % (browser, location, pagePath(self.path)))
+        self.reply(200, page_source)
+
+
+    def reply(self, status, body):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+    """Serves a fixture directory.  Port 0 picks a free port, the address
+    to hand to --replay is in url"""
+    daemon_threads = True
+
+    def __init__(self, directory, port=0, host="127.0.0.1", verbose=False):
+        HTTPServer.__init__(self, (host, port), ReplayHandler)
+        self.fixtures = Fixtures(directory)
+        self.url = "http://%s:%s" % (host, self.server_address[1])
+        self.verbose = verbose
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+    def start(self):
+        """Serves from a background thread"""
+        thread = threading.Thread(target=self.serve_forever, name="Replay")
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def main():
+    if len(sys.argv) < 2 or not os.path.isdir(sys.argv[1]):
+        sys.exit(__doc__)
+    server = ReplayServer(sys.argv[1], int(getOption("port", 8765)), verbose=True)
+    print("Serving %s recorded lookups from %s at %s"
+          % (len(server.fixtures.states), sys.argv[1], server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Local HTTP API for goodrx.py, used with --serve.
+
+Keeps goodrx.py running so browsers, HTTP sessions and caches stay warm
+between price checks:
+
+    python goodrx.py - Chrome 10 --serve 8080
+
+    POST /prices
+    {"drugs": [{"drug_name": "lipitor", "form": "tablet", "dosage": "40mg",
+                "quantity": "30", "label_override": "", "location": "53703"}],
+     "browsers": ["Chrome"], "timeout": 120}
+
+answers with the coupons for each drug and browser in the order asked for:
+
+    {"results": [{"drug": {...}, "browser": "Chrome", "status": "found",
+                  "coupons": [{"price": "4.37", "store_name": "...", "method": "Coupon"}]}]}
+
+status is found, none when the lookup finished without prices, failed
+when it gave up, with whatever coupons it had collected, and timeout when
+it didn't finish in time.  A request that would put more lookups in
+flight than the service takes gets a 503 with Retry-After.  GET /health
+reports on the workers and is a 503 once none are left.  Works on Python 2
+and 3 and doesn't import goodrx; the lookup service is handed in.
+"""
+import json
+try:
+    from urlparse import urlsplit
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from urllib.parse import urlsplit
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+# Largest request body read, in bytes
+MAX_BODY = 10 * 1024 * 1024
+
+
+class BadRequest(Exception):
+    pass
+
+
+def readDrugs(body, drug_type):
+    """The Drug records in a /prices request, given as objects with the
+    Drug field names or as lists in Drug field order"""
+    drugs = body.get("drugs")
+    if not isinstance(drugs, list) or not drugs:
+        raise BadRequest("drugs needs to be a non-empty list")
+    fields = drug_type._fields
+    found = []
+    for n, drug in enumerate(drugs):
+        if isinstance(drug, dict):
+            drug = [drug.get(field, "" if field == "label_override" else None)
+                    for field in fields]
+        if not isinstance(drug, list) or len(drug) != len(fields):
+            raise BadRequest("drugs[%s] needs the fields %s" % (n, ", ".join(fields)))
+        for field, value in zip(fields, drug):
+            if value is None or isinstance(value, (dict, list, bool)):
+                raise BadRequest("drugs[%s] is missing %s" % (n, field))
+        found.append(drug_type(*[str(value) for value in drug]))
+    return found
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if urlsplit(self.path).path != "/health":
+            return self.reply(404, {"error": "not found"})
+        health = self.server.service.health()
+        self.reply(200 if health["status"] == "ok" else 503, health)
+
+
+    def do_POST(self):
+        if urlsplit(self.path).path != "/prices":
+            return self.reply(404, {"error": "not found"})
+        server = self.server
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > MAX_BODY:
+                raise BadRequest("request body is over %s bytes" % (MAX_BODY,))
+            try:
+                body = json.loads(self.rfile.read(length).decode("utf-8"))
+            except ValueError:
+                raise BadRequest("request body isn't JSON")
+            if not isinstance(body, dict):
+                raise BadRequest("request body needs to be a JSON object")
+            drugs = readDrugs(body, server.drug_type)
+            browsers = body.get("browsers") or server.service.browsers()
+            unknown = [browser for browser in browsers if browser not in server.service.browsers()]
+            if unknown:
+                raise BadRequest("not serving %s, only %s"
+                                 % (", ".join(map(str, unknown)), ", ".join(server.service.browsers())))
+            timeout = float(body.get("timeout", server.timeout))
+        except (BadRequest, ValueError, TypeError) as e:
+            return self.reply(400, {"error": str(e)})
+
+        results = server.service.lookup(drugs, browsers, timeout)
+        if results is None:
+            return self.reply(503, {"error": "too many lookups in flight, try again later"},
+                              {"Retry-After": str(server.retry_after)})
+        self.reply(200, {"results": [{
+            "drug": dict(zip(server.drug_type._fields, drug)),
+            "browser": browser,
+            "status": "timeout" if coupons is None else
+                      ("failed" if failed else ("found" if coupons else "none")),
+            "coupons": [dict(zip(coupon._fields, coupon)) for coupon in coupons or []]}
+            for drug, browser, coupons, failed in results]})
+
+
+    def reply(self, status, document, headers=None):
+        body = json.dumps(document).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        self.server.log.info("%s %s" % (self.address_string(), format % args))
+
+
+class PriceServer(ThreadingMixIn, HTTPServer):
+    """Serves a lookup service, which needs lookup(drugs, browsers, timeout)
+    returning (drug, browser, coupons or None, failed) in order, or None
+    when it's too busy, plus health() and browsers()"""
+    daemon_threads = True
+
+    def __init__(self, service, drug_type, log, port, host="127.0.0.1",
+                 timeout=300, retry_after=30):
+        HTTPServer.__init__(self, (host, port), ServiceHandler)
+        self.service = service
+        self.drug_type = drug_type
+        self.log = log
+        self.timeout = timeout
+        self.retry_after = retry_after
@@ -0,0 +1,119 @@
+"""Checks that cutting the locationDetection container out of a page before
+parsing gives every parser backend the same coupons as parsing the whole
+page.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import goodrx
+
+
+def priceRows(count, start=0):
+    return "".join(
+        '<div class="price-row"><div class="store-name">Pharmacy %s</div>'
+        '<span class="font-weight-medium">$</span>'
+        '<span class="font-weight-medium">%.2f</span>'
+        '<button>Get Coupon</button></div>' % (n, 4 + n * 0.5)
+        for n in range(start, start + count))
+
+
+def page(before="", first="", inside="", after="", container="div", button=True):
+    """A price page with markup before the container, first in it, among the
+    rows and after it"""
+    return ('<html><head><title>Prices</title></head><body>%s'
+            '<%s class="prices">%s<div id="locationDetection"></div>%s%s%s%s</%s>'
+            '%s</body></html>' % (before, container, first, priceRows(3), inside, priceRows(2, 3),
+                                  '<div class="view-button">View more</div>' if button else "",
+                                  container, after))
+
+
+CASES = {
+    "plain": page(),
+    "comments": page(before="<!-- <div> --><div><!-- </div> --></div>",
+                     inside="<!-- </div></div> -->", after="<!-- <div class=prices> -->"),
+    "scripts": page(before="<script>var a = '<div><div>';</script>",
+                    inside="<script type='text/javascript'>document.write('</div>')</script>"
+                           "<style>div:after { content: '</div>' }</style>"),
+    "void tags": page(before="<img src=a.png><br><input type=text>",
+                      inside="<br><img src='b.png' /><hr><input name=q>"),
+    "unclosed paragraphs": page(before="<p>one<p>two", inside="<p>inside<p>again"),
+    "upper case": page(before="<DIV><DIV></DIV></DIV>", inside="<DIV class=note>note</DIV>"),
+    "textarea": page(before="<textarea><div></textarea>",
+                     first="<textarea></div><div></textarea>"),
+    "title": page(before="<title>a <div> title</title>", first="<title></div></title>"),
+    "raw text first": page(first="<script>'</div>'</script><!-- </div> --><style>/*</div>*/</style>"
+                                 "<textarea><div><div></textarea>"),
+    "marker in a comment": page(before='<!-- <div><div id="locationDetection"> -->'),
+    "marker in a script": page(before="<script>x = '<div><div id=\"locationDetection\">'</script>"),
+    "implied end container": page(container="li", before="<ul>", after="</ul>"),
+    "nested containers": page(before="<div class=outer><div>", after="</div></div>"),
+    "no view button": page(button=False),
+    "view button lookalikes": page(button=False, inside='<div class="view-button-old">x</div>'
+                                   '<p>view-button</p><div id="view-button"></div>'),
+    "view button among classes": page(button=False,
+                                      inside='<div class="btn view-button large">More</div>'),
+}
+
+
+def cutWith(parser, page_source, cut):
+    """What parser returns when locationContainer is cut"""
+    original = goodrx.locationContainer
+    goodrx.locationContainer = cut
+    try:
+        return parser(page_source)
+    finally:
+        goodrx.locationContainer = original
+
+
+def wholePage(parser, page_source):
+    """What parser returns when it parses the whole page"""
+    return cutWith(parser, page_source, lambda page_source: page_source)
+
+
+class ParserTest(unittest.TestCase):
+    def testSameAsWholePage(self):
+        for backend in goodrx.availableParsers():
+            parser = goodrx.CHROME_PARSERS[backend]
+            for name, page_source in CASES.items():
+                expected = wholePage(parser, page_source)
+                self.assertEqual(len(expected[0]), 5, "%s on %s" % (backend, name))
+                self.assertEqual(parser(page_source), expected, "%s on %s" % (backend, name))
+                self.assertEqual(parser(page_source, 3), (expected[0][3:], expected[1]),
+                                 "%s on %s from row 3" % (backend, name))
+
+
+    def testWholePageWhenCutMissesLocation(self):
+        page_source = CASES["plain"]
+        for backend in goodrx.availableParsers():
+            parser = goodrx.CHROME_PARSERS[backend]
+            self.assertEqual(cutWith(parser, page_source, lambda page_source: "<div><p>x</p></div>"),
+                             wholePage(parser, page_source), backend)
+
+
+    def testViewButton(self):
+        for name, page_source in CASES.items():
+            found = goodrx.hasViewButton(page_source)
+            self.assertEqual(found, name not in ("no view button", "view button lookalikes"), name)
+
+
+    def testCutsContainer(self):
+        for name in ("plain", "comments", "scripts", "void tags", "upper case", "textarea",
+                     "title", "raw text first", "nested containers"):
+            fragment = goodrx.locationContainer(CASES[name])
+            self.assertTrue(fragment.startswith('<div class="prices">'), name)
+            self.assertTrue(fragment.endswith("</div>"), name)
+            self.assertEqual(fragment.count("price-row"), 5, name)
+
+
+    def testWholePageWhenItCantCut(self):
+        for page_source in (CASES["implied end container"], "<html><body>no prices</body></html>"):
+            self.assertTrue(goodrx.locationContainer(page_source) is page_source)
+
+
+if __name__ == "__main__":
+    unittest.main()